@@ -1,13 +1,12 @@
-from flask import Flask, render_template, request, jsonify, redirect, send_from_directory, url_for, session, flash
+from flask import Flask, render_template, request, jsonify, redirect, send_from_directory, url_for, session, flash, abort
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import SQLAlchemyError
 from flask_wtf.csrf import CSRFProtect
-import logging
-from logging.handlers import RotatingFileHandler
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from functools import wraps
 import os
+import time
 from datetime import datetime, timedelta
 import uuid
 import json
@@ -15,64 +14,303 @@ import re
 import unicodedata
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from models import (
-    db, User, MerchantStore, Ad, Category, Country, State, City,
-    VIPPackage, VIPSubscription, AdSense, PaymentMethod, SiteSetting
+    db, User, MerchantStore, Ad, AdArchive, Category, Country, State, City,
+    VIPPackage, VIPSubscription, AdSense, PaymentMethod, SiteSetting, create_slug
 )
 from routes import bp as merchant_bp
+from keys import filter_ads_by_key
+from database import configure_database, retry_on_locked
+from routing import replica_binds, read_replica, init_replica_routing
+from instrumentation import init_instrumentation, endpoint_stats
+from metrics import init_metrics
+from profiling import init_profiling, collapsed_stacks
+from logconfig import init_logging
+from tracing import init_tracing, save_upload, trace_buffer
+from maintenance import (
+    upgrade_schema, backfill_ad_slugs, backfill_image_meta, migrate_integer_keys, expire_vip_subscriptions, expire_ads, archive_ads,
+    ad_expiry_date, recompute_vip_flags
+)
+from datagen import generate_data
+from warmup import init_warmup, warm_up
+from templating import build_bundle, init_templates
+from cache import cache, init_cache
+from pagecache import cache_page, init_page_cache, parse_ttls
+from compression import init_compression
+from assets import build_assets, init_assets
+from images import describe_image, init_images, parse_sizes
+import click
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)  # تعيين مدة الجلسة ليوم واحد
-database_url = os.environ.get('DATABASE_URL')
-if database_url and database_url.startswith('postgres://'):
-    database_url = database_url.replace('postgres://', 'postgresql://', 1)
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///classified_ads.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-# Remove file size limits
-app.config['MAX_CONTENT_LENGTH'] = None  # No limit on total upload size
-app.config['MAX_FILE_SIZE'] = None  # No limit on individual file size
-app.config['MAX_FILES'] = None  # No limit on number of files
-app.config['WTF_CSRF_ENABLED'] = True
-
-db.init_app(app)
-csrf = CSRFProtect(app)
+csrf = CSRFProtect()
 
 # Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'admin_login'
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(user_id)
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# Set up logging
-if not app.debug:
-    # Create logs directory if it doesn't exist
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    # Set up file handler
-    file_handler = RotatingFileHandler('logs/adsvairl.log', maxBytes=10240, backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-    ))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    
-    app.logger.setLevel(logging.INFO)
+
+def create_app(config=None):
+    """Configure the application and set up its extensions.
+
+    Routes, filters and CLI commands are registered on the module level `app`
+    when this module is imported; everything with side effects (logging,
+    database engines, upload directory) happens here, once per process; the
+    maintenance scheduler is started by the server (gunicorn.conf.py, run.py).
+    `config` overrides settings read from the environment, e.g.
+    create_app({'TRACE_SAMPLE_RATE': 0}).
+    """
+    if 'sqlalchemy' in app.extensions:
+        raise RuntimeError('create_app() has already run in this process')
+    started = time.perf_counter()
+    app.config['SECRET_KEY'] = 'your-secret-key-here'
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)  # تعيين مدة الجلسة ليوم واحد
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url and database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///classified_ads.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Read replicas for listing/search/API reads (comma separated URLs, see routing.py)
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(os.environ.get('DATABASE_REPLICA_URLS', ''))
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+    app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    # Remove file size limits
+    app.config['MAX_CONTENT_LENGTH'] = None  # No limit on total upload size
+    app.config['MAX_FILE_SIZE'] = None  # No limit on individual file size
+    app.config['MAX_FILES'] = None  # No limit on number of files
+    app.config['WTF_CSRF_ENABLED'] = True
+    # SQLite: apply WAL/busy-timeout pragmas and serialize writers (see database.py)
+    app.config['SQLITE_PRODUCTION_MODE'] = os.environ.get('SQLITE_PRODUCTION_MODE', 'true').lower() == 'true'
+    # Seconds between VIP expiry sweeps in the local scheduler thread (0 disables it, use cron instead)
+    app.config['VIP_SWEEP_INTERVAL'] = int(os.environ.get('VIP_SWEEP_INTERVAL', 0))
+    # Ad lifecycle: default lifetime, archive delay for inactive ads and sweep interval (0 disables)
+    app.config['AD_TTL_DAYS'] = int(os.environ.get('AD_TTL_DAYS', 60))
+    app.config['AD_ARCHIVE_AFTER_DAYS'] = int(os.environ.get('AD_ARCHIVE_AFTER_DAYS', 90))
+    app.config['AD_SWEEP_INTERVAL'] = int(os.environ.get('AD_SWEEP_INTERVAL', 0))
+    # Filter listings on the integer seq keys: true/false, or unset to switch over once `flask migrate-keys` has completed
+    app.config['INTEGER_KEYS_ENABLED'] = {'true': True, 'false': False}.get(os.environ.get('INTEGER_KEYS_ENABLED', '').lower())
+    # Per-request query counts and Server-Timing headers; queries slower than SLOW_QUERY_MS are logged
+    app.config['SQL_INSTRUMENTATION'] = os.environ.get('SQL_INSTRUMENTATION', 'true').lower() == 'true'
+    app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 100))
+    app.config['QUERY_STATS_TOP_N'] = int(os.environ.get('QUERY_STATS_TOP_N', 5))
+    # Server-Timing goes to admin sessions only unless this is set
+    app.config['SERVER_TIMING_PUBLIC'] = os.environ.get('SERVER_TIMING_PUBLIC', 'false').lower() == 'true'
+    # Each worker writes its query stats to QUERY_STATS_DIR (default instance/query_stats) for the admin page
+    app.config['QUERY_STATS_DIR'] = os.environ.get('QUERY_STATS_DIR')
+    app.config['QUERY_STATS_FLUSH_SECONDS'] = float(os.environ.get('QUERY_STATS_FLUSH_SECONDS', 5))
+    # Prometheus /metrics (set PROMETHEUS_MULTIPROC_DIR under gunicorn), only served to these addresses
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    app.config['METRICS_ALLOWED_IPS'] = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1')
+    # Sampling profiler switched on from /admin/profiling; profiles are kept in PROFILE_DIR (default instance/profiles)
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
+    app.config['PROFILE_INTERVAL_MS'] = int(os.environ.get('PROFILE_INTERVAL_MS', 5))
+    app.config['PROFILES_PER_ENDPOINT'] = int(os.environ.get('PROFILES_PER_ENDPOINT', 5))
+    # JSON logs written by a background thread (see logconfig.py), rotated by logrotate; LOG_MAX_BYTES rotates
+    # in-process instead, for single-process deployments only
+    app.config['LOG_FILE'] = os.environ.get('LOG_FILE', 'logs/adsvairl.log')
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    app.config['LOG_LEVELS'] = os.environ.get('LOG_LEVELS', '')
+    app.config['LOG_MAX_BYTES'] = int(os.environ.get('LOG_MAX_BYTES', 0))
+    app.config['LOG_BACKUP_COUNT'] = int(os.environ.get('LOG_BACKUP_COUNT', 10))
+    app.config['LOG_DEBUG_SAMPLE_RATE'] = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.01))
+    # Trace this fraction of requests (SQL, template and upload spans) into /admin/traces and TRACE_FILE (JSONL)
+    app.config['TRACE_SAMPLE_RATE'] = float(os.environ.get('TRACE_SAMPLE_RATE', 0.05))
+    app.config['TRACE_BUFFER_SIZE'] = int(os.environ.get('TRACE_BUFFER_SIZE', 200))
+    app.config['TRACE_FILE'] = os.environ.get('TRACE_FILE')
+    # Jinja bytecode cache (default instance/jinja_cache) and `flask compile-templates` bundle (default
+    # instance/compiled_templates), see templating.py
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR')
+    app.config['TEMPLATE_BUNDLE_DIR'] = os.environ.get('TEMPLATE_BUNDLE_DIR')
+    # Warm templates, lookups and hot queries before serving (gunicorn hooks, run.py); /ready reports it
+    app.config['WARM_UP'] = os.environ.get('WARM_UP', 'true').lower() == 'true'
+    # Shared cache tier: redis://..., sqlite:///path or memory (default: a SQLite file next to the database),
+    # behind a per-process LRU of CACHE_MAX_ENTRIES entries kept CACHE_LOCAL_TTL seconds, see cache.py
+    app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+    app.config['CACHE_LOCAL_TTL'] = int(os.environ.get('CACHE_LOCAL_TTL', 5))
+    # {% cache %} template fragments
+    app.config['FRAGMENT_CACHE_ENABLED'] = os.environ.get('FRAGMENT_CACHE_ENABLED', 'true').lower() == 'true'
+    app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+    app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+    # Anonymous full-page cache (pagecache.py): per-endpoint TTL overrides ("home=30,search=0"), how long
+    # an expired page is still served while it re-renders, and the largest page worth storing
+    app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', 'true').lower() == 'true'
+    app.config['PAGE_CACHE_TTLS'] = parse_ttls(os.environ.get('PAGE_CACHE_TTLS', ''))
+    app.config['PAGE_CACHE_STALE_SECONDS'] = int(os.environ.get('PAGE_CACHE_STALE_SECONDS', 300))
+    app.config['PAGE_CACHE_MAX_BYTES'] = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 1024 * 1024))
+    # Gzip/Brotli for text responses of at least COMPRESS_MIN_BYTES (compression.py); static files are
+    # precompressed by `flask build-assets` instead
+    app.config['COMPRESS_ENABLED'] = os.environ.get('COMPRESS_ENABLED', 'true').lower() == 'true'
+    app.config['COMPRESS_MIN_BYTES'] = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    # Resized uploads at /img/<w>x<h>/<upload>.<fmt> (images.py): the boxes templates may request (h=0 keeps
+    # the aspect ratio), the disk cache (default instance/image_cache) and limits on rendering new sizes
+    app.config['IMAGE_RESIZE_ENABLED'] = os.environ.get('IMAGE_RESIZE_ENABLED', 'true').lower() == 'true'
+    app.config['IMAGE_SIZES'] = parse_sizes(os.environ.get('IMAGE_SIZES', '96x96,160x160,300x300,640x384,1280x0'))
+    app.config['IMAGE_QUALITY'] = int(os.environ.get('IMAGE_QUALITY', 80))
+    app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR')
+    app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 1024 ** 3))
+    app.config['IMAGE_MAX_RENDERS'] = int(os.environ.get('IMAGE_MAX_RENDERS', 2))
+    app.config['IMAGE_RENDERS_PER_MINUTE'] = int(os.environ.get('IMAGE_RENDERS_PER_MINUTE', 120))
+    # Non-JPEG uploads larger than this get no placeholder when an ad is created (0 means no limit)
+    app.config['IMAGE_PLACEHOLDER_MAX_PIXELS'] = int(os.environ.get('IMAGE_PLACEHOLDER_MAX_PIXELS', 1000000))
+    app.config.update(config or {})
+    # Connection pool per worker process (server databases only)
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') and 'SQLALCHEMY_ENGINE_OPTIONS' not in app.config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true',
+        }
+
+    # Set up logging
+    init_logging(app)
     app.logger.info('Adsvairl startup')
 
-# Register blueprints
-app.register_blueprint(merchant_bp, url_prefix='/merchant')
+    db.init_app(app)
+    configure_database(app)
+    init_replica_routing(app)
+    init_instrumentation(app)
+    init_metrics(app)
+    init_profiling(app)
+    init_tracing(app)
+    init_cache(app)
+    init_page_cache(app)
+    init_compression(app)
+    init_assets(app)
+    init_images(app)
+    init_templates(app)
+    init_warmup(app)
+    csrf.init_app(app)
+    login_manager.init_app(app)
+
+    # Ensure upload directory exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Register blueprints
+    app.register_blueprint(merchant_bp, url_prefix='/merchant')
+
+    app.extensions['startup'] = {'create_app_ms': (time.perf_counter() - started) * 1000}
+    return app
+
+# Maintenance CLI commands (flask --app wsgi <command>) for cron
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables and indexes"""
+    upgrade_schema()
+    click.echo('Database schema is up to date')
+
+@app.cli.command('backfill-slugs')
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--all', 'recompute', is_flag=True, help='Recompute slugs for every ad')
+def backfill_slugs_command(batch_size, recompute):
+    """Store URL slugs for existing ads"""
+    result = backfill_ad_slugs(batch_size=batch_size, recompute=recompute)
+    click.echo(f"Updated {result['updated']} slugs")
+
+@app.cli.command('backfill-image-meta')
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--all', 'recompute', is_flag=True, help='Recompute the metadata of every image')
+def backfill_image_meta_command(batch_size, recompute):
+    """Store dimensions and placeholders of existing ad images"""
+    result = backfill_image_meta(batch_size=batch_size, recompute=recompute)
+    click.echo(f"Updated {result['updated']} ads")
+
+@app.cli.command('migrate-keys')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_keys_command(batch_size):
+    """Assign integer keys to existing rows and link ads to them"""
+    result = migrate_integer_keys(batch_size=batch_size)
+    for name, count in result.items():
+        click.echo(f'{name}: {count}')
+
+@app.cli.command('expire-vip')
+@click.option('--batch-size', default=500, show_default=True)
+def expire_vip_command(batch_size):
+    """Expire VIP subscriptions past their end date"""
+    result = expire_vip_subscriptions(batch_size=batch_size)
+    click.echo(f"Expired {result['expired']} subscriptions, updated {result['users_updated']} users")
+
+@app.cli.command('expire-ads')
+@click.option('--batch-size', default=500, show_default=True)
+def expire_ads_command(batch_size):
+    """Deactivate ads past their expiry date"""
+    result = expire_ads(batch_size=batch_size)
+    click.echo(f"Backfilled {result['backfilled']} expiry dates, expired {result['expired']} ads")
+
+@app.cli.command('archive-ads')
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--older-than-days', type=int, default=None, help='Defaults to AD_ARCHIVE_AFTER_DAYS')
+def archive_ads_command(batch_size, older_than_days):
+    """Move old inactive ads to the archive table"""
+    result = archive_ads(batch_size=batch_size, older_than_days=older_than_days)
+    click.echo(f"Archived {result['archived']} ads")
+
+@app.cli.command('generate-data')
+@click.option('--ads', default=100000, show_default=True)
+@click.option('--users', default=10000, show_default=True)
+@click.option('--countries', default=3, show_default=True, help='Up to 10 Arab countries')
+@click.option('--states-per-country', default=10, show_default=True)
+@click.option('--cities-per-state', default=10, show_default=True)
+@click.option('--category-skew', default=1.0, show_default=True, help='Zipf exponent, 0 spreads ads evenly')
+@click.option('--vip-share', default=0.05, show_default=True, help='Share of users with an active VIP subscription')
+@click.option('--store-share', default=0.02, show_default=True, help='Share of non-VIP users with a store')
+@click.option('--max-images', default=5, show_default=True, help='Images per ad are drawn from 0..N')
+@click.option('--english-share', default=0.2, show_default=True, help='Share of ads written in English')
+@click.option('--days', default=90, show_default=True, help='Spread ad creation dates over this many days')
+@click.option('--seed', default=42, show_default=True)
+@click.option('--batch-size', default=5000, show_default=True)
+def generate_data_command(**options):
+    """Bulk insert synthetic users, stores, subscriptions, locations and ads for load testing"""
+    upgrade_schema()
+    started = datetime.utcnow()
+    generate_data(log=click.echo, **options)
+    # Core inserts bypass the ORM events that invalidate cached categories and locations
+    cache.clear()
+    click.echo(f'Done in {(datetime.utcnow() - started).total_seconds():.0f}s')
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Precompile every template into a bundle of Python modules (run on each deploy)"""
+    path, count = build_bundle(app)
+    click.echo(f'Compiled {count} templates into {path}')
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Content-hash and precompress static/ into static/dist (run on each deploy)"""
+    files, variants = build_assets(app)
+    click.echo(f'Built {files} static files and {variants} compressed variants into static/dist')
+
+@app.cli.command('clear-cache')
+@click.option('--tag', 'tags', multiple=True, help='Only drop entries with this tag (repeatable)')
+def clear_cache_command(tags):
+    """Empty the shared cache, or only the given tags (e.g. after a deploy)"""
+    if tags:
+        cache.invalidate_tags(tags)
+    else:
+        cache.clear()
+    click.echo(f"Cleared {', '.join(tags) if tags else 'all entries'} in {app.config['CACHE_URL']}")
+
+@app.cli.command('warm-up')
+def warm_up_command():
+    """Compile templates and request the hot pages once, reporting timings"""
+    state = warm_up(app)
+    timings = state['timings']
+    click.echo(f"{state['templates']} templates in {timings['templates_ms']:.0f} ms, "
+               f"caches in {timings['caches_ms']:.0f} ms, requests in {timings['requests_ms']:.0f} ms")
+    if state['failed']:
+        raise click.ClickException('Failed: ' + ', '.join(state['failed']))
 
 # Site Settings Functions
 def get_site_setting(key, default=None):
-    setting = SiteSetting.query.filter_by(key=key).first()
-    return setting.value if setting else default
+    # Read on every render by inject_settings; commits to SiteSetting drop the 'settings' tag
+    value = cache.get_or_set(f'setting:{key}', lambda: db.session.query(SiteSetting.value).filter_by(key=key).scalar(),
+                             ttl=3600, tags=('settings',))
+    return default if value is None else value
 
 def set_site_setting(key, value, description=None):
     setting = SiteSetting.query.filter_by(key=key).first()
@@ -157,6 +395,7 @@ def admin_vip_packages_main():
     return render_template('admin/vip_packages.html', packages=packages, countries=countries)
 
 @app.route('/api/payment-methods/by-package/<package_id>')
+@read_replica
 def get_package_payment_methods(package_id):
     package = VIPPackage.query.get_or_404(package_id)
     payment_methods = package.payment_methods
@@ -192,6 +431,7 @@ def add_vip_package_main():
             advanced_analytics=bool(request.form.get('advanced_analytics')),
             custom_badge=request.form.get('custom_badge'),
             boost_in_search=bool(request.form.get('boost_in_search')),
+            ad_ttl_days=request.form.get('ad_ttl_days', type=int),
             is_active=True
         )
         
@@ -239,25 +479,6 @@ def toggle_vip_package_main(package_id):
     return redirect(url_for('admin_vip_packages_main'))
         
 
-# Helper function to create URL slug from Arabic text
-def create_slug(text):
-    """Convert Arabic text to URL-friendly slug"""
-    # Remove HTML tags if any
-    text = re.sub('<.*?>', '', text)
-    
-    # Replace Arabic spaces and punctuation
-    text = re.sub(r'[^\w\s-]', '', text)
-    text = re.sub(r'[-\s]+', '-', text)
-    
-    # Remove leading/trailing hyphens
-    text = text.strip('-')
-    
-    # Limit length
-    if len(text) > 50:
-        text = text[:50].rstrip('-')
-    
-    return text.lower() if text else 'ad'
-
 # Helper function for Arabic time ago
 def time_ago_arabic(dt):
     now = datetime.now()
@@ -286,6 +507,11 @@ def time_ago_filter(dt):
 def slug_filter(text):
     return create_slug(text)
 
+# Canonical ad URL from the stored slug, so listings don't recompute it per card
+@app.template_global('ad_url')
+def ad_url(ad, **kwargs):
+    return url_for('ad_details', ad_id=ad.id, slug=ad.slug or create_slug(ad.title), **kwargs)
+
 # Helper function to format phone number for WhatsApp
 def format_phone_for_whatsapp(phone):
     """Format phone number for WhatsApp URL"""
@@ -354,71 +580,97 @@ def get_adsense_ads(page_location=None, ad_type=None):
     return query.all()
 
 @app.route('/')
+@cache_page(60, tags=('ads', 'categories', 'locations', 'adsense', 'settings'))
+@read_replica
 def home():
     # Check if user has seen splash screen
     if not session.get('seen_splash'):
         session['seen_splash'] = True
         return render_template('splash.html')
         
-    categories = Category.query.filter_by(is_active=True).all()
     featured_ads = Ad.query.filter_by(is_featured=True, is_approved=True, is_active=True).limit(6).all()
     recent_ads = Ad.query.filter_by(is_approved=True, is_active=True).order_by(Ad.created_at.desc()).limit(12).all()
     
-    # Get location data for filters - convert to dictionaries for JSON serialization
-    countries = Country.query.filter_by(is_active=True).all()
-    states_query = State.query.all()
-    cities_query = City.query.all()
-    
-    # Convert to dictionaries for JSON serialization
-    states = [{'id': s.id, 'name': s.name, 'country_id': s.country_id} for s in states_query]
-    cities = [{'id': c.id, 'name': c.name, 'state_id': c.state_id} for c in cities_query]
-    
-    # Get AdSense ads for home page
-    adsense_ads = {
-        'banner': get_adsense_ads(ad_type='banner'),
-        'sidebar': get_adsense_ads(ad_type='sidebar'),
-        'content': get_adsense_ads(ad_type='content'),
-        'footer': get_adsense_ads(ad_type='footer')
-    }
+    # Categories, location filters and AdSense change only through the admin panel, whose
+    # commits invalidate these tags; plain dicts so they can be shared between workers
+    categories = cache.get_or_set('home:categories', lambda: [
+        {'id': c.id, 'name': c.name, 'icon': c.icon, 'color': c.color}
+        for c in Category.query.filter_by(is_active=True).all()
+    ], ttl=3600, tags=('categories',))
+    locations = cache.get_or_set('home:locations', lambda: {
+        'countries': [{'id': c.id, 'name': c.name} for c in Country.query.filter_by(is_active=True).all()],
+        'states': [{'id': s.id, 'name': s.name, 'country_id': s.country_id} for s in State.query.all()],
+        'cities': [{'id': c.id, 'name': c.name, 'state_id': c.state_id} for c in City.query.all()],
+    }, ttl=3600, tags=('locations',))
+    adsense_ads = cache.get_or_set('home:adsense', lambda: {
+        ad_type: [{'id': ad.id, 'name': ad.name, 'html_code': ad.html_code, 'is_active': ad.is_active}
+                  for ad in get_adsense_ads(ad_type=ad_type)]
+        for ad_type in ('banner', 'sidebar', 'content', 'footer')
+    }, ttl=3600, tags=('adsense',))
     
     return render_template('index.html', 
                          categories=categories, 
                          featured_ads=featured_ads, 
                          recent_ads=recent_ads,
-                         countries=countries,
-                         states=states,
-                         cities=cities,
+                         countries=locations['countries'],
+                         states=locations['states'],
+                         cities=locations['cities'],
                          adsense_ads=adsense_ads)
 
 
 
+@retry_on_locked()
+def increment_ad_views(ad_id):
+    """Atomic views_count + 1 that invalidates neither cached cards (keyed on updated_at) nor pages"""
+    Ad.query.filter_by(id=ad_id).execution_options(invalidate_cache=False).update(
+        {Ad.views_count: Ad.views_count + 1, Ad.updated_at: Ad.updated_at},
+        synchronize_session=False)
+    db.session.commit()
+
 @app.route('/ad/<ad_id>')
 @app.route('/ad/<ad_id>/<slug>')
+@cache_page(300, tags=('ads', 'categories', 'locations', 'settings'),
+            on_hit=lambda ad_id, slug=None: increment_ad_views(ad_id))
+@read_replica
 def ad_details(ad_id, slug=None):
-    ad = Ad.query.get_or_404(ad_id)
-    
-    # Create the correct slug for this ad
-    correct_slug = create_slug(ad.title)
-    
-    # If no slug provided or incorrect slug, redirect to correct URL
+    ad = db.session.get(Ad, ad_id)
+    if not ad:
+        # Archived ads answer 410 Gone, so crawlers drop the URL, with a link to their category
+        archived_ad = db.session.get(AdArchive, ad_id)
+        if not archived_ad:
+            abort(404)
+        category = db.session.get(Category, archived_ad.category_id) if archived_ad.category_id else None
+        return render_template('ad_gone.html', archived_ad=archived_ad, category=category), 410
+    
+    # If no slug provided or incorrect slug, redirect to the stored one
+    # (rows not yet backfilled by `flask backfill-slugs` fall back to the title)
+    correct_slug = ad.slug or create_slug(ad.title)
     if not slug or slug != correct_slug:
         return redirect(url_for('ad_details', ad_id=ad_id, slug=correct_slug), code=301)
     
     # Increment view count
-    ad.views_count += 1
-    db.session.commit()
+    increment_ad_views(ad.id)
     
     # Get related ads from same category
-    related_ads = Ad.query.filter(
-        Ad.category_id == ad.category_id,
+    related_ads = filter_ads_by_key(Ad.query.filter(
         Ad.id != ad.id,
         Ad.is_approved == True,
         Ad.is_active == True
-    ).limit(4).all()
+    ), 'category_id', ad.category_id).limit(4).all()
     
     return render_template('ad_details.html', ad=ad, related_ads=related_ads)
 
+@app.route('/ads/<slug>')
+@read_replica
+def ad_by_slug(slug):
+    """Resolve a bare slug to the newest live ad carrying it"""
+    ad = Ad.query.filter_by(slug=slug, is_approved=True, is_active=True)\
+             .order_by(Ad.created_at.desc()).first_or_404()
+    return redirect(ad_url(ad), code=301)
+
 @app.route('/all-ads')
+@cache_page(60, tags=('ads', 'locations', 'settings'))
+@read_replica
 def all_ads():
     page = request.args.get('page', 1, type=int)
     per_page = 12
@@ -436,15 +688,15 @@ def add_ad():
     return render_template('add_ad.html', categories=categories, countries=countries)
 
 @app.route('/api/categories')
+@read_replica
 def get_categories():
-    categories = Category.query.filter_by(is_active=True).all()
-    return jsonify([{
+    return jsonify(cache.get_or_set('api:categories', lambda: [{
         'id': cat.id,
         'name': cat.name,
         'name_en': cat.name_en,
         'icon': cat.icon,
         'color': cat.color
-    } for cat in categories])
+    } for cat in Category.query.filter_by(is_active=True).all()], ttl=3600, tags=('categories',)))
 
 
 
@@ -494,18 +746,22 @@ def auto_create_user(phone, email=None, location_data=None):
         db.session.rollback()
         raise e
 
+@retry_on_locked()
+def insert_ad(**fields):
+    """Insert and commit one ad, retried as a whole if SQLite is busy"""
+    new_ad = Ad(expires_at=ad_expiry_date(fields['category_id'], fields['user_id']), **fields)
+    db.session.add(new_ad)
+    db.session.commit()
+    return new_ad
+
 @app.route('/api/ads', methods=['POST'])
 def create_ad():
     try:
-        # Configure logging
-        app.logger.setLevel(logging.DEBUG)
-        
         if 'UPLOAD_FOLDER' not in app.config:
             app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
-            
-        app.logger.debug(f"Form data received: {request.form}")
-        app.logger.debug(f"Files received: {request.files}")
-        
+
+        app.logger.debug('Create ad fields: %s', sorted(request.form.keys()))
+
         # Ensure upload directory exists
         if not os.path.exists(app.config['UPLOAD_FOLDER']):
             os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -563,15 +819,20 @@ def create_ad():
         
         # Save images
         image_paths = []
+        image_meta = {}
         for file in uploaded_files:
             if file and file.filename:
                 filename = secure_filename(file.filename)
                 file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
+                save_upload(file, file_path)
                 image_paths.append(filename)
+                # Dimensions and an inline placeholder for the ad cards, computed once here
+                meta = describe_image(file_path, app.config['IMAGE_PLACEHOLDER_MAX_PIXELS'])
+                if meta is not None:
+                    image_meta[filename] = meta
 
         # Create new ad
-        new_ad = Ad(
+        new_ad = insert_ad(
             title=request.form.get('title'),
             description=request.form.get('description'),
             price=float(request.form.get('price')),
@@ -583,26 +844,22 @@ def create_ad():
             contact_phone=contact_phone,
             contact_email=contact_email,
             images=image_paths,
+            image_meta=image_meta,
             currency=request.form.get('currency', 'SAR'),
             is_active=True,
             is_approved=True
         )
-        
-        db.session.add(new_ad)
-        db.session.commit()
 
-        # Create slug from title
-        ad_slug = create_slug(new_ad.title)
-        
-        # Build the ad URL
-        ad_url = url_for('ad_details', ad_id=new_ad.id, slug=ad_slug, _external=True)
+        # Build the ad URL from the slug stored with the ad
+        new_ad_url = ad_url(new_ad, _external=True)
 
         response_data = {
             'success': True,
             'message': 'تم نشر إعلانك بنجاح',
             'ad_id': new_ad.id,
-            'ad_url': ad_url,
-            'redirect_url': ad_url
+            'ad_slug': new_ad.slug,
+            'ad_url': new_ad_url,
+            'redirect_url': new_ad_url
         }
 
         if 'temp_password' in locals() and temp_password:
@@ -626,9 +883,12 @@ def create_ad():
 
 
 @app.route('/category/<category_id>')
+@cache_page(120, tags=('ads', 'categories', 'locations', 'settings'))
+@read_replica
 def category_view(category_id):
     category = Category.query.get_or_404(category_id)
-    ads = Ad.query.filter_by(category_id=category_id, is_approved=True, is_active=True).order_by(Ad.created_at.desc()).all()
+    ads_query = filter_ads_by_key(Ad.query.filter_by(is_approved=True, is_active=True), 'category_id', category_id)
+    ads = ads_query.order_by(Ad.created_at.desc()).all()
     countries = Country.query.filter_by(is_active=True).all()
     
     return render_template('category.html', category=category, ads=ads, countries=countries)
@@ -727,15 +987,8 @@ def admin_ads():
     page = request.args.get('page', 1, type=int)
     status = request.args.get('status', 'all')
     
-    query = Ad.query
-    
-    if status == 'pending':
-        query = query.filter_by(is_approved=False)
-    elif status == 'approved':
-        query = query.filter_by(is_approved=True)
-    elif status == 'featured':
-        query = query.filter_by(is_featured=True)
-    
+    query = admin_ads_filter_query(status)
+
     ads = query.order_by(Ad.created_at.desc()).paginate(
         page=page, per_page=20, error_out=False)
     
@@ -786,6 +1039,86 @@ def delete_ad(ad_id):
     flash('تم حذف الإعلان', 'success')
     return redirect(url_for('admin_ads'))
 
+# Bulk moderation helpers
+BULK_BATCH_SIZE = 500
+
+def chunked(items, size=BULK_BATCH_SIZE):
+    """Yield successive lists of at most `size` items"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def admin_ads_filter_query(status):
+    """Base query for the admin ads list, shared with the bulk endpoint"""
+    query = Ad.query
+    if status == 'pending':
+        query = query.filter_by(is_approved=False)
+    elif status == 'approved':
+        query = query.filter_by(is_approved=True)
+    elif status == 'featured':
+        query = query.filter_by(is_featured=True)
+    return query
+
+@app.route('/admin/ads/bulk', methods=['POST'])
+@admin_required
+def bulk_ads_action():
+    """Apply one moderation action to many ads with set-based statements.
+
+    Accepts either a list of `ad_ids` or `select_all=1` with the current
+    `status` filter, and runs a single UPDATE/DELETE per batch of ids inside
+    one transaction.
+    """
+    action = request.form.get('action')
+    status = request.form.get('status', 'all')
+    bulk_actions = {
+        'approve': {'is_approved': True},
+        'reject': {'is_approved': False, 'is_active': False},
+        'feature': {'is_featured': True},
+        'unfeature': {'is_featured': False},
+    }
+    if action not in bulk_actions and action != 'delete':
+        flash('إجراء غير صالح', 'error')
+        return redirect(url_for('admin_ads', status=status))
+
+    if request.form.get('select_all') == '1':
+        ad_ids = [row.id for row in admin_ads_filter_query(status).with_entities(Ad.id)]
+    else:
+        ad_ids = request.form.getlist('ad_ids')
+
+    if not ad_ids:
+        flash('لم يتم تحديد أي إعلان', 'error')
+        return redirect(url_for('admin_ads', status=status))
+
+    affected = 0
+    image_files = []
+    try:
+        for batch in chunked(ad_ids):
+            if action == 'delete':
+                image_files.extend(
+                    image
+                    for row in db.session.query(Ad.images).filter(Ad.id.in_(batch))
+                    for image in (row.images or [])
+                )
+                affected += Ad.query.filter(Ad.id.in_(batch)).delete(synchronize_session=False)
+            else:
+                values = dict(bulk_actions[action], updated_at=datetime.utcnow())
+                affected += Ad.query.filter(Ad.id.in_(batch)).update(values, synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f'Error in bulk_ads_action: {str(e)}')
+        flash('حدث خطأ أثناء تنفيذ الإجراء الجماعي', 'error')
+        return redirect(url_for('admin_ads', status=status))
+
+    # Remove image files only once the rows are gone
+    for image in image_files:
+        image_path = os.path.join(app.config['UPLOAD_FOLDER'], image)
+        if os.path.exists(image_path):
+            os.remove(image_path)
+
+    flash(f'تم تنفيذ الإجراء على {affected} إعلان', 'success')
+    return redirect(url_for('admin_ads', status=status))
+
 @app.route('/admin/categories')
 @admin_required
 def admin_categories():
@@ -799,8 +1132,9 @@ def add_category():
     name_en = request.form.get('name_en')
     icon = request.form.get('icon')
     color = request.form.get('color')
+    ad_ttl_days = request.form.get('ad_ttl_days', type=int)
     
-    category = Category(name=name, name_en=name_en, icon=icon, color=color)
+    category = Category(name=name, name_en=name_en, icon=icon, color=color, ad_ttl_days=ad_ttl_days)
     db.session.add(category)
     db.session.commit()
     
@@ -813,6 +1147,79 @@ def admin_users():
     users = User.query.filter_by(is_admin=False).all()
     return render_template('admin/users.html', users=users)
 
+@app.route('/admin/query-stats')
+@admin_required
+def admin_query_stats():
+    endpoints, slow_queries, pids = endpoint_stats.snapshot()
+    return render_template('admin/query_stats.html', endpoints=endpoints, slow_queries=slow_queries,
+                           pids=pids, slow_query_ms=app.config['SLOW_QUERY_MS'],
+                           flush_seconds=app.config['QUERY_STATS_FLUSH_SECONDS'])
+
+@app.route('/admin/query-stats/reset', methods=['POST'])
+@admin_required
+def admin_query_stats_reset():
+    endpoint_stats.reset()
+    flash('تم تصفير إحصائيات الاستعلامات', 'success')
+    return redirect(url_for('admin_query_stats'))
+
+@app.route('/admin/profiling')
+@admin_required
+def admin_profiling():
+    store = app.extensions['profile_store']
+    endpoints = sorted(rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != 'static')
+    return render_template('admin/profiling.html', settings=store.settings(), profiles=store.summaries(),
+                           endpoints=endpoints)
+
+@app.route('/admin/profiling/toggle', methods=['POST'])
+@admin_required
+def admin_profiling_toggle():
+    store = app.extensions['profile_store']
+    if request.form.get('action') == 'enable':
+        try:
+            sample_rate = float(request.form.get('sample_rate', 10)) / 100
+        except ValueError:
+            sample_rate = 0.1
+        store.enable(min(max(sample_rate, 0.0), 1.0), request.form.getlist('endpoints'))
+        flash('تم تفعيل المحلل', 'success')
+    else:
+        store.disable()
+        flash('تم إيقاف المحلل', 'success')
+    return redirect(url_for('admin_profiling'))
+
+@app.route('/admin/profiling/clear', methods=['POST'])
+@admin_required
+def admin_profiling_clear():
+    app.extensions['profile_store'].clear()
+    flash('تم حذف نتائج التحليل المحفوظة', 'success')
+    return redirect(url_for('admin_profiling'))
+
+@app.route('/admin/traces')
+@admin_required
+def admin_traces():
+    return render_template('admin/traces.html', traces=trace_buffer.all(),
+                           sample_rate=app.config['TRACE_SAMPLE_RATE'])
+
+@app.route('/admin/traces/<trace_id>')
+@admin_required
+def admin_trace_details(trace_id):
+    trace = trace_buffer.get(trace_id)
+    if trace is None:
+        abort(404)
+    return render_template('admin/trace_details.html', trace=trace)
+
+@app.route('/admin/profiling/<endpoint_name>/<name>')
+@admin_required
+def admin_profile_details(endpoint_name, name):
+    profile = app.extensions['profile_store'].load(endpoint_name, name)
+    if profile is None:
+        abort(404)
+    if request.args.get('format') == 'collapsed':
+        return app.response_class(collapsed_stacks(profile), mimetype='text/plain', headers={
+            'Content-Disposition': f'attachment; filename={endpoint_name}-{name}.collapsed'})
+    top_stacks = sorted(profile['stacks'].items(), key=lambda item: item[1], reverse=True)[:30]
+    return render_template('admin/profile_details.html', profile=profile, endpoint_name=endpoint_name, name=name,
+                           top_stacks=top_stacks, total_samples=sum(profile['stacks'].values()))
+
 # AdSense Management Routes
 #############################
 
@@ -916,6 +1323,8 @@ def admin_adsense_delete(ad_id):
     return redirect(url_for('admin_adsense'))
 
 @app.route('/search')
+@cache_page(60, tags=('ads', 'categories', 'locations', 'settings'))
+@read_replica
 def search():
     query = request.args.get('q', '')
     category_id = request.args.get('category')
@@ -931,16 +1340,16 @@ def search():
         )
     
     if category_id:
-        ads_query = ads_query.filter_by(category_id=category_id)
+        ads_query = filter_ads_by_key(ads_query, 'category_id', category_id)
     
     if country_id:
-        ads_query = ads_query.filter_by(country_id=country_id)
+        ads_query = filter_ads_by_key(ads_query, 'country_id', country_id)
     
     if state_id:
-        ads_query = ads_query.filter_by(state_id=state_id)
+        ads_query = filter_ads_by_key(ads_query, 'state_id', state_id)
     
     if city_id:
-        ads_query = ads_query.filter_by(city_id=city_id)
+        ads_query = filter_ads_by_key(ads_query, 'city_id', city_id)
     
     ads = ads_query.order_by(Ad.created_at.desc()).all()
     categories = Category.query.filter_by(is_active=True).all()
@@ -953,12 +1362,14 @@ def search():
 
 # VIP System Routes
 @app.route('/become-vip')
+@read_replica
 def become_vip():
     countries = Country.query.filter_by(is_active=True).all()
     packages = VIPPackage.query.filter_by(is_active=True).all()
     return render_template('become_vip.html', countries=countries, packages=packages)
 
 @app.route('/api/vip-packages/country/<country_code>')
+@read_replica
 def get_vip_packages_by_country(country_code):
     try:
         country = Country.query.filter_by(code=country_code.upper()).first_or_404()
@@ -1004,6 +1415,7 @@ def get_vip_packages_by_country(country_code):
         }), 500
 
 @app.route('/api/vip-packages/<country_id>')
+@read_replica
 def get_vip_packages(country_id):
     packages = VIPPackage.query.filter_by(country_id=country_id, is_active=True).all()
     return jsonify([{
@@ -1063,7 +1475,7 @@ def vip_subscribe():
             
             if file and allowed_file(file.filename):
                 filename = secure_filename(f'vip_proof_{form_data["customer_email"]}_{uuid.uuid4()}.{file.filename.rsplit(".", 1)[1].lower()}')
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                save_upload(file, os.path.join(app.config['UPLOAD_FOLDER'], filename))
                 payment_proof_path = filename
             else:
                 return jsonify({'error': 'نوع الملف غير مدعوم. المسموح به: صور أو PDF'}), 400
@@ -1246,7 +1658,7 @@ def update_store_banner():
     
     if file:
         filename = secure_filename(f"store_banner_{user.store.id}_{file.filename}")
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        save_upload(file, os.path.join(app.config['UPLOAD_FOLDER'], filename))
         user.store.banner_url = filename
         
         try:
@@ -1272,7 +1684,7 @@ def update_store_logo():
     
     if file:
         filename = secure_filename(f"store_logo_{user.store.id}_{file.filename}")
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        save_upload(file, os.path.join(app.config['UPLOAD_FOLDER'], filename))
         user.store.logo_url = filename
         
         try:
@@ -1349,6 +1761,99 @@ def reject_vip_subscription(subscription_id):
     flash('تم رفض طلب الاشتراك VIP', 'success')
     return redirect(url_for('admin_vip_subscriptions'))
 
+@app.route('/admin/vip/subscriptions/bulk', methods=['POST'])
+@admin_required
+def bulk_vip_subscriptions_action():
+    """Approve or reject many VIP subscriptions in one transaction.
+
+    Approval is grouped by package so each batch needs one UPDATE per
+    package duration of the pending subscriptions, followed by one UPDATE
+    recomputing the owners' VIP flag; rejection recomputes it as well.
+    """
+    action = request.form.get('action')
+    status_filter = request.form.get('payment_status', 'all')
+    if action not in ('approve', 'reject'):
+        flash('إجراء غير صالح', 'error')
+        return redirect(url_for('admin_vip_subscriptions', payment_status=status_filter))
+
+    if request.form.get('select_all') == '1':
+        query = VIPSubscription.query
+        if status_filter != 'all':
+            query = query.filter_by(payment_status=status_filter)
+        subscription_ids = [row.id for row in query.with_entities(VIPSubscription.id)]
+    else:
+        subscription_ids = request.form.getlist('subscription_ids')
+
+    if not subscription_ids:
+        flash('لم يتم تحديد أي طلب', 'error')
+        return redirect(url_for('admin_vip_subscriptions', payment_status=status_filter))
+
+    now = datetime.utcnow()
+    admin_id = session.get('admin_id')
+    affected = 0
+    try:
+        for batch in chunked(subscription_ids):
+            if action == 'reject':
+                user_ids = [row.user_id for row in db.session.query(VIPSubscription.user_id).filter(
+                    VIPSubscription.id.in_(batch)).distinct()]
+                affected += VIPSubscription.query.filter(VIPSubscription.id.in_(batch)).update({
+                    'payment_status': 'failed',
+                    'is_active': False,
+                    'processed_at': now,
+                    'processed_by': admin_id,
+                    'admin_notes': request.form.get('rejection_reason', ''),
+                    'updated_at': now
+                }, synchronize_session=False)
+                # Owners left without another active subscription lose VIP
+                recompute_vip_flags(user_ids, now)
+                continue
+
+            # Completed subscriptions keep their dates, re-approving them must not extend VIP
+            pending = VIPSubscription.query.filter(
+                VIPSubscription.id.in_(batch),
+                VIPSubscription.payment_status != 'completed'
+            )
+            durations = db.session.query(VIPPackage.id, VIPPackage.duration_days).join(
+                VIPSubscription, VIPSubscription.package_id == VIPPackage.id
+            ).filter(VIPSubscription.id.in_(batch), VIPSubscription.payment_status != 'completed').distinct().all()
+            for package_id, duration_days in durations:
+                affected += pending.filter(
+                    VIPSubscription.package_id == package_id
+                ).update({
+                    'payment_status': 'completed',
+                    'is_active': True,
+                    'start_date': now,
+                    'end_date': now + timedelta(days=duration_days),
+                    'processed_at': now,
+                    'processed_by': admin_id,
+                    'updated_at': now
+                }, synchronize_session=False)
+
+            user_ids = [row.user_id for row in db.session.query(VIPSubscription.user_id).filter(
+                VIPSubscription.id.in_(batch)).distinct()]
+            recompute_vip_flags(user_ids, now)
+
+            # Create merchant stores for new VIP users that don't have one yet
+            users_without_store = User.query.filter(
+                User.id.in_(user_ids),
+                User.is_vip == True,
+                ~User.id.in_(db.session.query(MerchantStore.owner_id))
+            ).with_entities(User.id, User.username).all()
+            db.session.add_all([
+                MerchantStore(owner_id=user_id, name=f"متجر {username}")
+                for user_id, username in users_without_store
+            ])
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f'Error in bulk_vip_subscriptions_action: {str(e)}')
+        flash('حدث خطأ أثناء تنفيذ الإجراء الجماعي', 'error')
+        return redirect(url_for('admin_vip_subscriptions', payment_status=status_filter))
+
+    status = 'قبول' if action == 'approve' else 'رفض'
+    flash(f'تم {status} {affected} طلب اشتراك VIP', 'success')
+    return redirect(url_for('admin_vip_subscriptions', payment_status=status_filter))
+
 
 @app.route('/admin/vip-packages/add', methods=['POST'])
 @admin_required
@@ -1369,6 +1874,7 @@ def add_vip_package():
             priority_support=bool(request.form.get('priority_support')),
             advanced_analytics=bool(request.form.get('advanced_analytics')),
             boost_in_search=bool(request.form.get('boost_in_search')),
+            ad_ttl_days=request.form.get('ad_ttl_days', type=int),
             is_active=True
         )
         
@@ -1624,44 +2130,49 @@ def admin_add_city():
         return redirect(url_for('admin_locations'))
 
 @app.route('/api/states/<country_id>')
+@read_replica
 def get_states(country_id):
     try:
-        # Get country and its states in one query
-        country = db.session.get(Country, country_id)
-        if not country:
+        def load_states():
+            country = db.session.get(Country, country_id)
+            if not country:
+                return None
+            states = State.query.filter_by(country_id=country_id).order_by(State.name).all()
+            return {
+                'states': [{
+                    'id': state.id,
+                    'name': state.name,
+                    'name_en': state.name_en
+                } for state in states],
+                'country_phone_code': country.phone_code
+            }
+
+        body = cache.get_or_set(f'api:states:{country_id}', load_states, ttl=3600, tags=('locations',))
+        if body is None:
             return jsonify({'error': 'الدولة غير موجودة'}), 404
-            
-        # Get states ordered by name
-        states = State.query.filter_by(country_id=country_id).order_by(State.name).all()
-        
-        return jsonify({
-            'states': [{
-                'id': state.id,
-                'name': state.name,
-                'name_en': state.name_en
-            } for state in states],
-            'country_phone_code': country.phone_code
-        })
+        return jsonify(body)
     except Exception as e:
         app.logger.error(f'Error in get_states: {str(e)}')
         return jsonify({'error': 'حدث خطأ في تحميل المحافظات'}), 500
 
 @app.route('/api/cities/<state_id>')
+@read_replica
 def get_cities(state_id):
     try:
-        # Get state and its cities in one query
-        state = db.session.get(State, state_id)
-        if not state:
+        def load_cities():
+            if not db.session.get(State, state_id):
+                return None
+            cities = City.query.filter_by(state_id=state_id).order_by(City.name).all()
+            return [{
+                'id': city.id,
+                'name': city.name,
+                'name_en': city.name_en
+            } for city in cities]
+
+        cities = cache.get_or_set(f'api:cities:{state_id}', load_cities, ttl=3600, tags=('locations',))
+        if cities is None:
             return jsonify({'error': 'المحافظة غير موجودة'}), 404
-            
-        # Get cities ordered by name
-        cities = City.query.filter_by(state_id=state_id).order_by(City.name).all()
-        
-        return jsonify([{
-            'id': city.id,
-            'name': city.name,
-            'name_en': city.name_en
-        } for city in cities])
+        return jsonify(cities)
     except Exception as e:
         app.logger.error(f'Error in get_cities: {str(e)}')
         return jsonify({'error': 'حدث خطأ في تحميل المدن'}), 500
@@ -1712,6 +2223,7 @@ def admin_delete_city(city_id):
 
 
 if __name__ == '__main__':
+    create_app()
     with app.app_context():
         db.create_all()
         
@@ -1785,4 +2297,6 @@ if __name__ == '__main__':
             db.session.commit()
             print("Created sample AdSense ads")
     
+    if app.config['WARM_UP']:
+        warm_up(app)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
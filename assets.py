@@ -0,0 +1,176 @@
+"""Static asset build, fingerprinted asset URLs and static file serving.
+
+`flask --app wsgi build-assets` copies every file under static/ (except
+uploads/) to static/dist/ under a content-hashed name, writes `.gz` and,
+with the optional `brotli` package, `.br` variants of the text files at
+the highest compression levels, and records the mapping in
+static/dist/manifest.json. The static route then answers each request
+with the smallest variant the client accepts, so text assets are never
+compressed per request. A manifest entry whose source file is newer
+than the build is ignored with a warning, so a forgotten rebuild never
+serves an old file.
+
+Templates link files with `asset_url('js/main.js')`, which returns the
+hashed static/dist/ URL of the build, or for files outside it (uploads,
+unbuilt trees) the plain URL with `?v=` derived from the file's size and
+modification time. Both change whenever the content does, so they are
+served `immutable` for a year and repeat visits make no requests for
+them; a stale `?v=` gets the current file with revalidation. Every
+static response supports If-None-Match/If-Modified-Since and Range.
+"""
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from compression import BEST_LEVELS, COMPRESSIBLE_MIMETYPES, accepted_encoding, compressed_variants
+
+logger = logging.getLogger('adsvairl.assets')
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+# Generated or user content, never part of the build
+SKIP_DIRS = {DIST_DIR, 'uploads'}
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+ONE_YEAR = 365 * 24 * 3600
+
+
+def hashed_name(path, digest):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{digest[:10]}{ext}'
+
+
+def source_files(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.relpath(os.path.join(root, d), static_folder) not in SKIP_DIRS)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+
+def build_assets(app):
+    """Hash and precompress static/ into static/dist; returns (files, compressed variants)"""
+    target = os.path.join(app.static_folder, DIST_DIR)
+    shutil.rmtree(target, ignore_errors=True)
+    manifest = {}
+    variants = 0
+    for name, path in source_files(app.static_folder):
+        with open(path, 'rb') as f:
+            data = f.read()
+        manifest[name] = hashed_name(name, hashlib.sha256(data).hexdigest())
+        output = os.path.join(target, manifest[name])
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'wb') as f:
+            f.write(data)
+        if mimetypes.guess_type(name)[0] in COMPRESSIBLE_MIMETYPES:
+            for encoding, compressed in compressed_variants(data, BEST_LEVELS).items():
+                with open(output + SUFFIXES[encoding], 'wb') as f:
+                    f.write(compressed)
+                variants += 1
+    with open(os.path.join(target, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return len(manifest), variants
+
+
+def load_manifest(app):
+    """{source path: hashed path} of the current build, without entries older than their source"""
+    path = os.path.join(app.static_folder, DIST_DIR, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        manifest = json.load(f)
+    built_at = os.path.getmtime(path)
+    stale = [name for name in manifest
+             if not os.path.exists(os.path.join(app.static_folder, name))
+             or os.path.getmtime(os.path.join(app.static_folder, name)) > built_at]
+    if stale:
+        logger.warning('Static files changed since the last build, serving them unhashed: %s; '
+                       'rebuild with `flask build-assets`', ', '.join(stale))
+    return {name: hashed for name, hashed in manifest.items() if name not in stale}
+
+
+def file_version(static_folder, filename):
+    """Short fingerprint of a file's size and mtime, None if it doesn't exist"""
+    path = safe_join(static_folder, filename)
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        return None
+    if stat is None:
+        return None
+    return hashlib.md5(f'{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()[:10]
+
+
+def assets_version(app, manifest):
+    """Fingerprint of every URL asset_url() can return: the build's hashed names and the
+    `?v=` versions of files outside it"""
+    digest = hashlib.md5(json.dumps(manifest, sort_keys=True).encode())
+    for name, _ in source_files(app.static_folder):
+        if name not in manifest:
+            digest.update(f'{name}:{file_version(app.static_folder, name)}'.encode())
+    return digest.hexdigest()[:10]
+
+
+def asset_url(filename, _external=False):
+    """Cache-busting URL of a file under static/ (template global)"""
+    manifest = current_app.extensions.get('assets', {})
+    if filename in manifest:
+        return url_for('static', filename=f'{DIST_DIR}/{manifest[filename]}', _external=_external)
+    version = file_version(current_app.static_folder, filename)
+    if version is None:
+        return url_for('static', filename=filename, _external=_external)
+    return url_for('static', filename=filename, v=version, _external=_external)
+
+
+def make_immutable(response):
+    if response.status_code in (200, 206, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+    return response
+
+
+def send_asset(directory, filename):
+    """send_from_directory, preferring a precompressed sibling the client accepts"""
+    available = [encoding for encoding, suffix in SUFFIXES.items()
+                 if os.path.isfile(safe_join(directory, filename + suffix) or '')]
+    encoding = accepted_encoding(available) if available else None
+    if encoding is None:
+        response = send_from_directory(directory, filename)
+    else:
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(directory, filename + SUFFIXES[encoding], mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    """Serve /static from the asset build when there is one, and add asset_url()"""
+    manifest = load_manifest(app)
+    app.extensions['assets'] = manifest
+    app.add_template_global(asset_url)
+    # Cached fragments embed asset_url() results, so a rebuild or changed static file must miss them too
+    app.jinja_env.fragment_cache_version += f'-{assets_version(app, manifest)}'
+    dist = os.path.join(app.static_folder, DIST_DIR)
+
+    def static(filename):
+        if filename.startswith(DIST_DIR + '/'):
+            # Content-hashed: never changes under this name
+            return make_immutable(send_asset(dist, filename[len(DIST_DIR) + 1:]))
+        if filename in manifest:
+            return send_asset(dist, manifest[filename])
+        response = send_from_directory(app.static_folder, filename)
+        version = request.args.get('v')
+        if version and version == file_version(app.static_folder, filename):
+            return make_immutable(response)
+        return response
+
+    app.view_functions['static'] = static
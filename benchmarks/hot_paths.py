@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Latency benchmark for the public and admin hot paths.
+
+Seeds a fresh SQLite database with a reproducible data set, then drives
+each scenario through the Flask test client and reports p50/p95 latency,
+SQL statements per request and memory allocated per request (measured in
+a separate tracemalloc pass so it doesn't skew the timings).
+
+Results can be stored as a named baseline under benchmarks/baselines/ and
+later runs compared against it; a scenario whose p50 grows by more than
+--threshold percent, or that issues more queries, fails the comparison.
+
+    python benchmarks/hot_paths.py --save-baseline default --note "why it was re-recorded"
+    python benchmarks/hot_paths.py --compare default
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, 'benchmarks', 'baselines')
+
+WORDS = ['سيارة', 'شقة', 'هاتف', 'أثاث', 'وظيفة', 'لابتوب', 'دراجة', 'ساعة', 'كاميرا', 'مكيف']
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def seed_database(db, ads_count, seed):
+    """Small but realistic data set; the same seed gives the same rows"""
+    from models import User, Category, Country, State, City, Ad, VIPPackage, VIPSubscription
+
+    rng = random.Random(seed)
+    db.create_all()
+    admin = User(username='bench-admin', email='admin@bench.local', is_admin=True)
+    users = [User(username=f'bench-user-{i}', email=f'user{i}@bench.local', phone=f'05{i:08d}')
+             for i in range(50)]
+    categories = [Category(name=word, name_en=f'Category {i}', icon='fas fa-tag', color='#3B82F6')
+                  for i, word in enumerate(WORDS[:6])]
+    countries = [Country(name=f'دولة {i}', name_en=f'Country {i}', code=f'C{i}', currency='SAR')
+                 for i in range(3)]
+    db.session.add_all([admin, *users, *categories, *countries])
+    db.session.flush()
+    states = [State(name=f'منطقة {i}', name_en=f'State {i}', country_id=countries[i % 3].id) for i in range(9)]
+    db.session.add_all(states)
+    db.session.flush()
+    cities = [City(name=f'مدينة {i}', name_en=f'City {i}', state_id=states[i % 9].id) for i in range(27)]
+    db.session.add_all(cities)
+    db.session.flush()
+
+    package = VIPPackage(name='Gold', duration_days=30, price=100, currency='SAR', country_id=countries[0].id)
+    db.session.add(package)
+    db.session.flush()
+    now = datetime.utcnow()
+    for user in users[:5]:
+        db.session.add(VIPSubscription(user_id=user.id, package_id=package.id,
+                                       payment_status='completed', is_active=True,
+                                       start_date=now, end_date=now + timedelta(days=30)))
+
+    for i in range(ads_count):
+        city = rng.choice(cities)
+        state = next(state for state in states if state.id == city.state_id)
+        word = rng.choice(WORDS)
+        db.session.add(Ad(
+            title=f'{word} للبيع رقم {i}', description=f'{word} بحالة ممتازة ' * rng.randint(2, 10),
+            price=rng.randint(10, 100000), user_id=rng.choice(users).id,
+            category_id=rng.choice(categories).id, country_id=state.country_id, state_id=state.id,
+            city_id=city.id, images=[], is_featured=rng.random() < 0.05,
+            is_approved=rng.random() < 0.9, contact_phone='0500000000',
+            created_at=now - timedelta(minutes=rng.randint(0, 60 * 24 * 60)),
+        ))
+        if i % 500 == 499:
+            db.session.flush()
+    db.session.commit()
+    return {
+        'admin_id': admin.id,
+        'category_id': categories[0].id,
+        'country_id': countries[0].id,
+        'state_id': states[0].id,
+        'ad': Ad.query.filter_by(is_approved=True, is_active=True).order_by(Ad.created_at.desc()).first(),
+    }
+
+
+def jpeg_bytes(size=(640, 480)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+
+def scenarios(app, ids):
+    """name -> callable(client) returning a response"""
+    from app import ad_url
+
+    image = jpeg_bytes()
+    with app.test_request_context():
+        ad_path = ad_url(ids['ad'])
+
+    def create_ad(client):
+        return client.post('/api/ads', content_type='multipart/form-data', data={
+            'title': 'سيارة للبيع', 'description': 'سيارة بحالة ممتازة', 'price': '25000',
+            'category_id': ids['category_id'], 'country_id': ids['country_id'], 'contact_phone': '0500000001',
+            'images': [(io.BytesIO(image), 'one.jpg'), (io.BytesIO(image), 'two.jpg')],
+        })
+
+    return {
+        'home': lambda client: client.get('/'),
+        'all_ads': lambda client: client.get('/all-ads'),
+        'category_view': lambda client: client.get(f"/category/{ids['category_id']}"),
+        'search': lambda client: client.get('/search?q=' + WORDS[0]),
+        'search_filtered': lambda client: client.get(
+            f"/search?q={WORDS[1]}&category={ids['category_id']}&country_id={ids['country_id']}&state_id={ids['state_id']}"),
+        'ad_details': lambda client: client.get(ad_path),
+        'create_ad': create_ad,
+        'api_states': lambda client: client.get(f"/api/states/{ids['country_id']}"),
+        'api_cities': lambda client: client.get(f"/api/cities/{ids['state_id']}"),
+        'api_categories': lambda client: client.get('/api/categories'),
+        'admin_dashboard': lambda client: client.get('/admin/dashboard'),
+        'admin_ads': lambda client: client.get('/admin/ads'),
+        'admin_vip_dashboard': lambda client: client.get('/admin/vip'),
+    }
+
+
+def run_scenario(client, request, iterations, warmup):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    for _ in range(warmup):
+        response = request(client)
+        if response.status_code >= 400:
+            raise RuntimeError(f'HTTP {response.status_code}')
+
+    queries = []
+    count = [0]
+
+    def count_query(*args):
+        count[0] += 1
+
+    event.listen(Engine, 'after_cursor_execute', count_query)
+    latencies = []
+    try:
+        for _ in range(iterations):
+            count[0] = 0
+            start = time.perf_counter()
+            request(client)
+            latencies.append(time.perf_counter() - start)
+            queries.append(count[0])
+    finally:
+        event.remove(Engine, 'after_cursor_execute', count_query)
+
+    allocated = []
+    for _ in range(max(3, iterations // 10)):
+        tracemalloc.start()
+        request(client)
+        allocated.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'queries': statistics.median(queries),
+        'peak_alloc_kb': statistics.median(allocated) / 1024,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'scenario':<22}{'p50 ms':>10}{'base':>10}{'change':>9}{'queries':>9}{'base':>7}")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f'{name:<22}{result["p50_ms"]:>10.2f}{"-":>10}')
+            continue
+        change = (result['p50_ms'] / base['p50_ms'] - 1) * 100 if base['p50_ms'] else 0.0
+        flag = ''
+        if change > threshold or result['queries'] > base['queries']:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<22}{result['p50_ms']:>10.2f}{base['p50_ms']:>10.2f}{change:>+8.1f}%"
+              f"{result['queries']:>9g}{base['queries']:>7g}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ads', type=int, default=2000, help='Ads in the seeded database')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--only', action='append', help='Run only these scenarios')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--note', help='Stored with --save-baseline, e.g. the change that moved it')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--threshold', type=float, default=20.0, help='Allowed p50 increase in percent')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='adsvairl-bench-')
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    from app import create_app, db
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+        'LOG_FILE': os.path.join(workdir, 'bench.log'),
+        'PROFILE_DIR': os.path.join(workdir, 'profiles'),
+        'TRACE_SAMPLE_RATE': 0,
+        'SLOW_QUERY_MS': 100000,
+        'WTF_CSRF_ENABLED': False,
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        # Measure rendering, not page cache hits (loadtest.py covers those end to end)
+        'PAGE_CACHE_ENABLED': False,
+        # Seeded through the ORM, so every ad has its integer keys
+        'INTEGER_KEYS_ENABLED': True,
+    })
+    with app.app_context():
+        ids = seed_database(db, args.ads, args.seed)
+        db.session.expunge_all()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['seen_splash'] = True
+        session['admin_id'] = ids['admin_id']
+
+    with app.app_context():
+        ids['ad'] = db.session.merge(ids['ad'])
+        all_scenarios = scenarios(app, ids)
+    selected = {name: request for name, request in all_scenarios.items() if not args.only or name in args.only}
+
+    print(f'{args.ads} ads, {args.iterations} iterations per scenario')
+    print(f"{'scenario':<22}{'p50 ms':>10}{'p95 ms':>10}{'mean ms':>10}{'queries':>9}{'alloc KB':>10}")
+    results = {}
+    for name, request in selected.items():
+        result = run_scenario(client, request, args.iterations, args.warmup)
+        results[name] = result
+        print(f"{name:<22}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['mean_ms']:>10.2f}"
+              f"{result['queries']:>9g}{result['peak_alloc_kb']:>10.0f}")
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'{args.save_baseline}.json')
+        with open(path, 'w') as f:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'machine': platform.platform(),
+                'ads': args.ads, 'seed': args.seed, 'iterations': args.iterations,
+                'note': args.note, 'results': results,
+            }, f, indent=2, sort_keys=True)
+        print(f'\nSaved baseline {path}')
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json')) as f:
+            baseline = json.load(f)
+        if baseline.get('note'):
+            print(f"\nBaseline {args.compare} ({baseline['created_at']}): {baseline['note']}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
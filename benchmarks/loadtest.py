@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""HTTP load test against a running instance.
+
+Virtual users replay a weighted mix of the real user journeys (homepage,
+category browsing, search, ad details, posting an ad with images and,
+when admin credentials are given, moderation) over keep-alive
+connections. The load is stepped through increasing concurrency levels
+and each level reports throughput, p50/p95/p99 latency and error rate,
+plus the SQLite writer lock waits and retries read from /metrics, so the
+point where latency climbs faster than throughput is easy to spot.
+
+Reports can be written as JSON and compared across configurations:
+
+    python benchmarks/loadtest.py http://127.0.0.1:5000 --levels 1,4,16 --output sqlite.json
+    python benchmarks/loadtest.py --compare sqlite.json postgres.json
+
+Posting ads writes real rows and uploads to the target; point it at a
+scratch database (see `flask generate-data`), never at production.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import quote, urlsplit
+
+DEFAULT_MIX = 'home=20,category=25,search=20,ad=25,post_ad=5,moderate=5'
+SEARCH_TERMS = ['سيارة', 'شقة', 'هاتف', 'أثاث', 'وظيفة', 'لابتوب', 'دراجة', 'ساعة', 'كاميرا', 'مكيف']
+LOCK_METRICS = {
+    'adsvairl_db_writer_lock_wait_seconds_sum': 'lock_wait_seconds',
+    'adsvairl_db_writer_lock_wait_seconds_count': 'lock_waits',
+    'adsvairl_db_lock_retries_total': 'lock_retries',
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Client:
+    """Minimal HTTP/1.1 client with keep-alive and a cookie jar"""
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.cookies = {}
+        self._reader = self._writer = None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = self._writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        try:
+            return await asyncio.wait_for(self._request(method, path, body, headers or {}), self.timeout)
+        except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError, ValueError) as e:
+            await self.close()
+            raise HTTPError(type(e).__name__) from e
+
+    async def _request(self, method, path, body, headers):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Connection: keep-alive']
+        if self.cookies:
+            lines.append('Cookie: ' + '; '.join(f'{k}={v}' for k, v in self.cookies.items()))
+        if body or method == 'POST':
+            lines.append(f'Content-Length: {len(body)}')
+        lines.extend(f'{k}: {v}' for k, v in headers.items())
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ValueError('connection closed')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await self._reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == 'set-cookie':
+                self._store_cookie(value)
+            response_headers[name] = value
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self._reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self._reader.readline()
+                    break
+                chunks.append(await self._reader.readexactly(size))
+                await self._reader.readline()
+            content = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            content = await self._reader.readexactly(int(response_headers['content-length']))
+        elif method == 'HEAD' or status in (204, 304):
+            content = b''
+        else:
+            content = await self._reader.read()
+            response_headers['connection'] = 'close'
+
+        if response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response_headers, content
+
+    def _store_cookie(self, header):
+        name, _, value = header.split(';', 1)[0].partition('=')
+        attributes = header.lower()
+        if not value or 'max-age=0' in attributes or 'expires=thu, 01 jan 1970' in attributes:
+            self.cookies.pop(name.strip(), None)
+        else:
+            self.cookies[name.strip()] = value.strip()
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
+        body.write(str(value).encode() + b'\r\n')
+    for name, filename, content in files:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                   f'Content-Type: image/jpeg\r\n\r\n'.encode())
+        body.write(content + b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def form(fields):
+    body = '&'.join(f'{quote(str(k))}={quote(str(v))}' for k, v in fields.items())
+    return body.encode(), 'application/x-www-form-urlencoded'
+
+
+def jpeg_bytes(size=(800, 600)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 64).convert('RGB').save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+
+def csrf_token(html):
+    match = (re.search(rb'name="csrf_token"[^>]*value="([^"]+)"', html)
+             or re.search(rb'name="csrf-token" content="([^"]+)"', html))
+    if not match:
+        raise HTTPError('no csrf token')
+    return match.group(1).decode()
+
+
+class Target:
+    """What the scenarios need to know about the instance under test"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.categories = []
+        self.ad_paths = []
+        self.locations = []
+        self.images = []
+        self.admin = None
+
+    def client(self):
+        return Client(self.host, self.port, self.timeout)
+
+    async def discover(self, admin_email=None, admin_password=None):
+        client = self.client()
+        try:
+            status, _, content = await client.request('GET', '/api/categories')
+            if status != 200:
+                raise SystemExit(f'GET /api/categories returned {status}')
+            self.categories = [category['id'] for category in json.loads(content)]
+
+            paths = set()
+            for page in range(1, 6):
+                _, _, content = await client.request('GET', f'/all-ads?page={page}')
+                paths.update(re.findall(r'href="(/ad/[^"]+)"', content.decode('utf-8', 'replace')))
+            self.ad_paths = sorted(paths)
+
+            _, _, content = await client.request('GET', '/add-ad')
+            select = re.search(rb'name="country_id".*?</select>', content, re.S)
+            countries = re.findall(r'<option value="([^"]+)"', select.group(0).decode()) if select else []
+            for country_id in countries[:5]:
+                _, _, content = await client.request('GET', f'/api/states/{country_id}')
+                for state in json.loads(content).get('states', [])[:3]:
+                    _, _, content = await client.request('GET', f"/api/cities/{state['id']}")
+                    cities = [city['id'] for city in json.loads(content)] or ['']
+                    self.locations.append((country_id, state['id'], cities[0]))
+            if not self.locations:
+                self.locations = [(country_id, '', '') for country_id in countries]
+
+            if admin_email:
+                self.admin = (admin_email, admin_password)
+                await VirtualUser(self, 0).login(client)
+        finally:
+            await client.close()
+
+        if not self.categories or not self.ad_paths or not self.locations:
+            raise SystemExit('The target has no categories or approved ads; seed it with `flask generate-data`')
+        self.images = [jpeg_bytes() for _ in range(2)]
+
+
+class VirtualUser:
+    def __init__(self, target, number):
+        self.target = target
+        self.rng = random.Random(number)
+        self.csrf = None
+        self.is_admin = False
+
+    async def expect(self, client, method, path, body=b'', content_type=None, ok=(200,)):
+        headers = {'Content-Type': content_type} if content_type else {}
+        status, _, content = await client.request(method, path, body, headers)
+        if status not in ok:
+            raise HTTPError(f'HTTP {status}')
+        return content
+
+    async def home(self, client):
+        await self.expect(client, 'GET', '/')
+
+    async def category(self, client):
+        category_id = self.rng.choice(self.target.categories)
+        await self.expect(client, 'GET', f'/category/{category_id}')
+
+    async def search(self, client):
+        path = '/search?q=' + quote(self.rng.choice(SEARCH_TERMS))
+        if self.rng.random() < 0.5:
+            country_id, state_id, _ = self.rng.choice(self.target.locations)
+            path += f'&category={self.rng.choice(self.target.categories)}&country_id={country_id}&state_id={state_id}'
+        await self.expect(client, 'GET', path)
+
+    async def ad(self, client):
+        await self.expect(client, 'GET', self.rng.choice(self.target.ad_paths))
+
+    async def post_ad(self, client):
+        if self.csrf is None:
+            self.csrf = csrf_token(await self.expect(client, 'GET', '/add-ad'))
+        country_id, state_id, city_id = self.rng.choice(self.target.locations)
+        files = [('images', f'loadtest-{uuid.uuid4().hex}.jpg', image) for image in self.target.images]
+        body, content_type = multipart({
+            'csrf_token': self.csrf,
+            'title': f'{self.rng.choice(SEARCH_TERMS)} للبيع',
+            'description': 'إعلان تجريبي من اختبار الحمل',
+            'price': self.rng.randint(10, 100000),
+            'currency': 'SAR',
+            'category_id': self.rng.choice(self.target.categories),
+            'country_id': country_id, 'state_id': state_id, 'city_id': city_id,
+            'contact_phone': f'05{self.rng.randint(0, 10 ** 8 - 1):08d}',
+        }, files)
+        await self.expect(client, 'POST', '/api/ads', body, content_type, ok=(200, 201))
+
+    async def login(self, client):
+        email, password = self.target.admin
+        token = csrf_token(await self.expect(client, 'GET', '/admin/login', ok=(200, 302)))
+        body, content_type = form({'csrf_token': token, 'email': email, 'password': password})
+        status, headers, _ = await client.request('POST', '/admin/login', body, {'Content-Type': content_type})
+        if status != 302 or 'dashboard' not in headers.get('location', ''):
+            raise SystemExit('Admin login failed; check --admin-email/--admin-password')
+        self.is_admin = True
+        self.csrf = None  # login starts a new session
+
+    async def moderate(self, client):
+        if not self.is_admin:
+            await self.login(client)
+        content = await self.expect(client, 'GET', '/admin/ads?status=pending')
+        actions = re.findall(rb'action="(/admin/ads/[^/"]+/(?:approve|reject))"', content)
+        if actions:
+            body, content_type = form({'csrf_token': csrf_token(content)})
+            await self.expect(client, 'POST', self.rng.choice(actions).decode(), body, content_type, ok=(200, 302))
+
+    async def run(self, mix, deadline, samples):
+        names, weights = zip(*mix.items())
+        client = self.target.client()
+        try:
+            while time.monotonic() < deadline:
+                name = self.rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                error = None
+                try:
+                    await getattr(self, name)(client)
+                except HTTPError as e:
+                    error = str(e)
+                samples.append((name, time.perf_counter() - started, error))
+        finally:
+            await client.close()
+
+
+async def scrape_lock_metrics(target):
+    """Cumulative lock wait counters from /metrics, or None if unavailable"""
+    client = target.client()
+    try:
+        status, _, content = await client.request('GET', '/metrics')
+    except HTTPError:
+        return None
+    finally:
+        await client.close()
+    if status != 200:
+        return None
+    values = dict.fromkeys(LOCK_METRICS.values(), 0.0)
+    for line in content.decode().splitlines():
+        name, _, value = line.partition(' ')
+        key = LOCK_METRICS.get(name.split('{')[0])
+        if key:
+            values[key] += float(value.split()[0])
+    return values
+
+
+def summarize(samples, elapsed):
+    latencies = [duration for _, duration, _ in samples]
+    errors = {}
+    for _, _, error in samples:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    scenarios = {}
+    for name in sorted({name for name, _, _ in samples}):
+        durations = [duration for sample_name, duration, _ in samples if sample_name == name]
+        failed = sum(1 for sample_name, _, error in samples if sample_name == name and error)
+        scenarios[name] = {
+            'requests': len(durations),
+            'p50_ms': percentile(durations, 50) * 1000,
+            'p95_ms': percentile(durations, 95) * 1000,
+            'errors': failed,
+        }
+    return {
+        'requests': len(samples),
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0.0,
+        'error_rate': sum(errors.values()) / len(samples) if samples else 0.0,
+        'errors': errors,
+        'scenarios': scenarios,
+    }
+
+
+async def run_level(target, mix, concurrency, duration, ramp):
+    before = await scrape_lock_metrics(target)
+    samples = []
+    started = time.monotonic()
+    deadline = started + duration
+    users = []
+    for number in range(concurrency):
+        users.append(asyncio.create_task(VirtualUser(target, concurrency * 1000 + number).run(mix, deadline, samples)))
+        if ramp:
+            await asyncio.sleep(ramp / concurrency)
+    await asyncio.gather(*users)
+    result = summarize(samples, time.monotonic() - started)
+    result['concurrency'] = concurrency
+    after = await scrape_lock_metrics(target)
+    if before is not None and after is not None:
+        result['lock_waits'] = int(after['lock_waits'] - before['lock_waits'])
+        result['lock_wait_ms'] = (after['lock_wait_seconds'] - before['lock_wait_seconds']) * 1000
+        result['lock_retries'] = int(after['lock_retries'] - before['lock_retries'])
+    return result
+
+
+def capacity(levels, slo_ms, max_error_rate):
+    """Highest throughput among levels that meet the p95 and error budget"""
+    passing = [level for level in levels if level['p95_ms'] <= slo_ms and level['error_rate'] <= max_error_rate]
+    return max(passing, key=lambda level: level['throughput_rps']) if passing else None
+
+
+def print_levels(levels, header=True):
+    if header:
+        print(f"{'users':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+              f"{'lock waits':>12}{'wait ms':>9}{'retries':>9}")
+    peak = max((level['throughput_rps'] for level in levels), default=0) or 1
+    for level in levels:
+        bar = '#' * int(level['throughput_rps'] / peak * 20) if len(levels) > 1 else ''
+        print(f"{level['concurrency']:>6}{level['throughput_rps']:>9.1f}{level['p50_ms']:>9.1f}"
+              f"{level['p95_ms']:>9.1f}{level['p99_ms']:>9.1f}{level['error_rate']:>8.1%}"
+              f"{level.get('lock_waits', '-'):>12}{level.get('lock_wait_ms', 0):>9.0f}"
+              f"{level.get('lock_retries', '-'):>9}  {bar}")
+
+
+def print_scenarios(level):
+    print(f"\nper scenario at {level['concurrency']} users:")
+    print(f"{'scenario':<12}{'requests':>10}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}")
+    for name, result in level['scenarios'].items():
+        print(f"{name:<12}{result['requests']:>10}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['errors']:>8}")
+    for error, count in sorted(level['errors'].items(), key=lambda item: -item[1]):
+        print(f'  {count} x {error}')
+
+
+def compare_reports(paths):
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+    print(f"{'users':>6}" + ''.join(f"{report['label'][:18]:>20}" for report in reports))
+    print(f"{'':>6}" + ''.join(f"{'req/s  p95 ms':>20}" for _ in reports))
+    concurrencies = sorted({level['concurrency'] for report in reports for level in report['levels']})
+    for concurrency in concurrencies:
+        row = f'{concurrency:>6}'
+        for report in reports:
+            level = next((level for level in report['levels'] if level['concurrency'] == concurrency), None)
+            row += f"{level['throughput_rps']:>11.1f}{level['p95_ms']:>9.1f}" if level else f"{'-':>20}"
+        print(row)
+    print()
+    for report in reports:
+        best = report['capacity']
+        summary = f"{best['throughput_rps']:.1f} req/s at {best['concurrency']} users" if best else 'no level met the SLO'
+        print(f"capacity {report['label']}: {summary} (p95 <= {report['slo_ms']:g} ms)")
+
+
+def parse_mix(value, with_admin):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ('home', 'category', 'search', 'ad', 'post_ad', 'moderate'):
+            raise SystemExit(f'Unknown scenario {name!r}')
+        if float(weight or 1) > 0 and (name != 'moderate' or with_admin):
+            mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:5000')
+    parser.add_argument('--levels', default='1,2,4,8,16,32', help='Concurrent users per step')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per step')
+    parser.add_argument('--ramp', type=float, default=2, help='Seconds to start all users of a step')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Scenario weights, e.g. home=1,search=3')
+    parser.add_argument('--admin-email')
+    parser.add_argument('--admin-password')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--slo-ms', type=float, default=500, help='p95 budget used for the capacity figure')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--label', help='Name of this configuration in the report')
+    parser.add_argument('--output', help='Write the JSON report here')
+    parser.add_argument('--compare', nargs='+', metavar='REPORT', help='Compare saved reports and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_reports(args.compare)
+        return
+
+    mix = parse_mix(args.mix, bool(args.admin_email))
+    levels = [int(level) for level in args.levels.split(',')]
+    target = Target(args.url, args.timeout)
+    asyncio.run(target.discover(args.admin_email, args.admin_password))
+    print(f'{args.url}: {len(target.categories)} categories, {len(target.ad_paths)} ads sampled, '
+          f'mix {", ".join(f"{k}={v:g}" for k, v in mix.items())}')
+
+    results = []
+    for concurrency in levels:
+        results.append(asyncio.run(run_level(target, mix, concurrency, args.duration, args.ramp)))
+        print_levels(results[-1:], header=len(results) == 1)
+    print('\nthroughput vs latency:')
+    print_levels(results)
+    print_scenarios(max(results, key=lambda level: level['concurrency']))
+
+    best = capacity(results, args.slo_ms, args.max_error_rate)
+    if best:
+        print(f"\ncapacity: {best['throughput_rps']:.1f} req/s at {best['concurrency']} users "
+              f"(p95 <= {args.slo_ms:g} ms, errors <= {args.max_error_rate:.0%})")
+    else:
+        print(f'\ncapacity: no level met p95 <= {args.slo_ms:g} ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'label': args.label or os.path.splitext(os.path.basename(args.output))[0],
+                'url': args.url,
+                'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+                'duration': args.duration,
+                'mix': mix,
+                'slo_ms': args.slo_ms,
+                'levels': results,
+                'capacity': best,
+            }, f, indent=2, ensure_ascii=False)
+        print(f'Saved {args.output}')
+    if any(level['error_rate'] > args.max_error_rate for level in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
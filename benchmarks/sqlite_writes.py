@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Concurrent-write benchmark for the SQLite engine profile in database.py.
+
+Worker processes create ads and bump view counts against a fresh SQLite
+file, once with SQLITE_PRODUCTION_MODE off (rollback journal, no writer
+lock) and once on, and the throughput, latency percentiles and
+"database is locked" failures of both runs are printed side by side.
+
+    python benchmarks/sqlite_writes.py --workers 8 --ops 200
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def worker(args):
+    index, ops, seed_ids = args
+    from sqlalchemy.exc import OperationalError
+    from app import app, db, insert_ad, increment_ad_views
+
+    latencies, errors = [], 0
+    with app.app_context():
+        db.engine.dispose(close=False)  # Don't share the parent's connections
+        ad_id = seed_ids['ad_id']
+        for i in range(ops):
+            start = time.perf_counter()
+            try:
+                if i % 2:
+                    increment_ad_views(ad_id)
+                else:
+                    insert_ad(
+                        title=f'Benchmark ad {index}-{i}', description='benchmark', price=100,
+                        category_id=seed_ids['category_id'], country_id=seed_ids['country_id'],
+                        state_id=None, city_id=None, user_id=seed_ids['user_id'],
+                        contact_phone='0500000000', contact_email=None, images=[],
+                        currency='SAR', is_active=True, is_approved=True
+                    )
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def run_mode(workers, ops):
+    """Child process entry point: benchmark one configuration, print JSON"""
+    from app import create_app, db
+    from models import User, Category, Country, Ad
+
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com')
+        category = Category(name='Benchmark')
+        country = Country(name='Benchmark', code='BM')
+        db.session.add_all([user, category, country])
+        db.session.flush()
+        ad = Ad(title='Seed', description='seed', price=1, user_id=user.id,
+                category_id=category.id, country_id=country.id)
+        db.session.add(ad)
+        db.session.commit()
+        seed_ids = {'user_id': user.id, 'category_id': category.id,
+                    'country_id': country.id, 'ad_id': ad.id}
+        journal_mode = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+        db.engine.dispose()
+
+    start = time.perf_counter()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        results = pool.map(worker, [(i, ops, seed_ids) for i in range(workers)])
+    elapsed = time.perf_counter() - start
+
+    latencies = [value for result in results for value in result[0]]
+    print(json.dumps({
+        'journal_mode': journal_mode,
+        'ops': len(latencies),
+        'errors': sum(result[1] for result in results),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=200, help='Writes per worker')
+    parser.add_argument('--run-mode', choices=['true', 'false'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        sys.path.insert(0, ROOT)
+        run_mode(args.workers, args.ops)
+        return
+
+    print(f'{args.workers} workers x {args.ops} writes')
+    print(f"{'mode':<12}{'journal':<10}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'errors':>8}")
+    for mode in ('false', 'true'):
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ,
+                       DATABASE_URL=f'sqlite:///{os.path.join(workdir, "bench.db")}',
+                       SQLITE_PRODUCTION_MODE=mode)
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-mode', mode,
+                 '--workers', str(args.workers), '--ops', str(args.ops)],
+                cwd=workdir, env=env, check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+        label = 'production' if mode == 'true' else 'default'
+        print(f"{label:<12}{result['journal_mode']:<10}{result['throughput']:>10.1f}"
+              f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['max_ms']:>10.2f}{result['errors']:>8}")
+
+
+if __name__ == '__main__':
+    main()
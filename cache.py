@@ -0,0 +1,444 @@
+"""Two-tier cache shared by all gunicorn workers, and the `{% cache %}` tag.
+
+`cache` keeps a small LRU in each process in front of a shared tier
+chosen by CACHE_URL:
+
+    redis://host:6379/0     a Redis server (needs the `redis` package)
+    sqlite:////path/file    a local SQLite file, the single-box stand-in
+    memory                  no shared tier, every process on its own
+
+By default the shared tier is a SQLite file next to the SQLite database
+(`<database>.cache`), or instance/cache.db for server databases. Entries
+carry tags; `invalidate_tags` drops them from the shared tier and from
+this process's LRU at once, while other processes keep their local copy
+for at most CACHE_LOCAL_TTL seconds. `get_or_set` computes a missing value
+once: threads of a process wait on a lock, other processes wait for the
+shared entry while one of them holds `lock:<key>`.
+
+Commits that touch the models in MODEL_TAGS, through the ORM or bulk
+Query.update()/delete(), invalidate their tags, so anything cached under
+those tags is rebuilt after an edit.
+
+    {% cache ['ad-card', ad.id, ad.updated_at], 300 %} ... {% endcache %}
+
+renders the block once and reuses the markup for the given number of
+seconds (FRAGMENT_CACHE_TTL when omitted). Keys built from a row's id and
+updated_at change whenever the row is edited through the ORM, so edited
+ads never show stale cards; view counts are bumped without touching
+updated_at and may lag by up to the TTL. Fragments are tagged `fragments`
+and dropped with category and location changes, since those names appear
+in cards and sections, and their keys include the templates' modification
+time so a deploy never serves markup rendered by the old templates.
+"""
+import logging
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from metrics import record_cache_lookup
+from models import db, Ad, AdSense, Category, City, Country, SiteSetting, State
+from templating import newest_template_mtime
+
+logger = logging.getLogger('adsvairl.cache')
+
+MISSING = object()
+
+# Tags invalidated by any committed insert, update or delete of these models
+MODEL_TAGS = {
+    Ad: ('ads',),
+    Category: ('categories', 'fragments'),
+    Country: ('locations', 'fragments'),
+    State: ('locations', 'fragments'),
+    City: ('locations', 'fragments'),
+    AdSense: ('adsense',),
+    SiteSetting: ('settings',),
+}
+
+
+class LocalCache:
+    """Thread-safe LRU cache with per-entry expiry and tags"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}  # tag -> keys
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """Shared tier in a SQLite file, for running on one box without Redis.
+
+    Each thread of each process opens its own connection (reopened after
+    a fork). Writes are not synced to disk: a crash only loses cache.
+    """
+
+    PURGE_EVERY = 1000  # sets, on average, between sweeps of expired rows
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_entry '
+                         '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_tag '
+                         '(tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID')
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache_entry WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl, tags=()):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?)', (key, value, time.time() + ttl))
+            conn.executemany('INSERT OR IGNORE INTO cache_tag VALUES (?, ?)', [(tag, key) for tag in tags])
+        if random.randrange(self.PURGE_EVERY) == 0:
+            self.purge()
+
+    def add(self, key, value, ttl):
+        """Set key only if it is missing or expired; returns whether it was set"""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_entry WHERE key = ? AND expires_at <= ?', (key, time.time()))
+            cursor = conn.execute('INSERT OR IGNORE INTO cache_entry VALUES (?, ?, ?)', (key, value, time.time() + ttl))
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+            conn.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+
+    def invalidate_tags(self, tags):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for tag in tags:
+                conn.execute('DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_tag WHERE tag = ?)', (tag,))
+                conn.execute('DELETE FROM cache_tag WHERE tag = ?', (tag,))
+
+    def purge(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_entry WHERE expires_at <= ?', (time.time(),))
+            conn.execute('DELETE FROM cache_tag WHERE key NOT IN (SELECT key FROM cache_entry)')
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_entry')
+            conn.execute('DELETE FROM cache_tag')
+
+
+class RedisCache:
+    """Shared tier on a Redis server; tags are Redis sets of keys"""
+
+    def __init__(self, url, prefix='adsvairl:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(f'CACHE_URL={url} needs the redis package (pip install redis)')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl, tags=()):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, value, px=int(ttl * 1000))
+        for tag in tags:
+            pipe.sadd(f'{self.prefix}tag:{tag}', key)
+        pipe.execute()
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value, px=int(ttl * 1000), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def invalidate_tags(self, tags):
+        for tag in tags:
+            tag_key = f'{self.prefix}tag:{tag}'
+            keys = [self.prefix + key.decode() for key in self.client.smembers(tag_key)]
+            self.client.delete(tag_key, *keys)
+
+    def purge(self):
+        pass  # Redis expires keys itself
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*', count=1000):
+            self.client.delete(key)
+
+
+class TieredCache:
+    """Process-local LRU in front of an optional shared tier.
+
+    Shared-tier errors are logged and treated as misses, so an unreachable
+    Redis slows the site down instead of taking it offline.
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, local, shared=None, local_ttl=5, lock_timeout=10):
+        self.local = local
+        self.shared = shared
+        self.local_ttl = local_ttl
+        self.lock_timeout = lock_timeout
+        self._locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+
+    def _shared_call(self, method, *args, default=None):
+        if self.shared is None:
+            return default
+        try:
+            return getattr(self.shared, method)(*args)
+        except Exception:
+            logger.warning('Shared cache %s failed', method, exc_info=True)
+            return default
+
+    def _get_shared(self, key):
+        blob = self._shared_call('get', key)
+        if blob is None:
+            return MISSING
+        value, tags = pickle.loads(zlib.decompress(blob))
+        self.local.set(key, value, self.local_ttl, tags)
+        return value
+
+    def get(self, key, default=None):
+        value = self.local.get(key, MISSING)
+        if value is MISSING:
+            value = self._get_shared(key)
+        record_cache_lookup(key.split(':', 1)[0], value is not MISSING)
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl, tags=()):
+        tags = tuple(tags)
+        self.local.set(key, value, ttl if self.shared is None else min(ttl, self.local_ttl), tags)
+        blob = zlib.compress(pickle.dumps((value, tags), pickle.HIGHEST_PROTOCOL), 1)
+        self._shared_call('set', key, blob, ttl, tags)
+
+    def add(self, key, value, ttl):
+        """Set key only if no live entry exists (across processes when shared); returns whether it was set"""
+        if self.shared is None:
+            with self._locks[hash(key) % self.LOCK_STRIPES]:
+                if self.local.get(key, MISSING) is not MISSING:
+                    return False
+                self.local.set(key, value, ttl)
+                return True
+        blob = zlib.compress(pickle.dumps((value, ()), pickle.HIGHEST_PROTOCOL), 1)
+        return self._shared_call('add', key, blob, ttl, default=False)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self._shared_call('delete', key)
+
+    def invalidate_tags(self, tags):
+        tags = tuple(tags)
+        self.local.invalidate_tags(tags)
+        self._shared_call('invalidate_tags', tags)
+
+    def clear(self):
+        self.local.clear()
+        self._shared_call('clear')
+
+    def get_or_set(self, key, compute, ttl, tags=()):
+        """Return the cached value of key, computing and storing it once on a miss"""
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        with self._locks[hash(key) % self.LOCK_STRIPES]:
+            # Another thread may have filled it while we waited
+            value = self.local.get(key, MISSING)
+            if value is not MISSING:
+                return value
+            lock_key = f'lock:{key}'
+            if self.shared is None or self._shared_call('add', lock_key, b'1', self.lock_timeout, default=True):
+                try:
+                    value = compute()
+                    self.set(key, value, ttl, tags)
+                finally:
+                    self._shared_call('delete', lock_key)
+                return value
+            # Another process is computing it
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = self._get_shared(key)
+                if value is not MISSING:
+                    return value
+            logger.warning('Gave up waiting for %s to be computed elsewhere', key)
+            value = compute()
+            self.set(key, value, ttl, tags)
+            return value
+
+
+cache = TieredCache(LocalCache())
+
+
+def shared_backend(url):
+    if url == 'memory':
+        return None
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url)
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):])
+    raise ValueError(f'Unsupported CACHE_URL: {url}')
+
+
+def default_cache_url(app):
+    with app.app_context():
+        database = db.engine.url.database
+        if db.engine.dialect.name == 'sqlite' and database not in (None, '', ':memory:'):
+            return f'sqlite:///{database}.cache'
+    return 'sqlite:///' + os.path.join(app.instance_path, 'cache.db')
+
+
+def fragment_key(key, version):
+    parts = key if isinstance(key, (list, tuple)) else [key]
+    return ':'.join(['fragment', version] + [str(part) for part in parts])
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache_enabled=True, fragment_cache_ttl=300, fragment_cache_version='0')
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, ttl, caller):
+        if not self.environment.fragment_cache_enabled:
+            return caller()
+        key = fragment_key(key, self.environment.fragment_cache_version)
+        html = cache.get(key)
+        if html is None:
+            html = str(caller())
+            cache.set(key, html, ttl if ttl is not None else self.environment.fragment_cache_ttl, ('fragments',))
+        return Markup(html)
+
+
+def init_cache(app):
+    """Set up the shared tier, register {% cache %} and the invalidation hooks"""
+    cache.local.max_entries = app.config.get('CACHE_MAX_ENTRIES', 10000)
+    cache.local_ttl = app.config.get('CACHE_LOCAL_TTL', 5)
+    url = app.config.get('CACHE_URL') or default_cache_url(app)
+    cache.shared = shared_backend(url)
+    cache.local.clear()
+    app.extensions['cache'] = cache
+    app.config['CACHE_URL'] = url
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache_enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+    app.jinja_env.fragment_cache_ttl = app.config.get('FRAGMENT_CACHE_TTL', 300)
+    # Markup cached by a previous deploy is not reused once the templates change (init_assets adds the assets)
+    app.jinja_env.fragment_cache_version = f'{newest_template_mtime(app):.0f}'
+
+    @event.listens_for(Session, 'after_flush')
+    def collect_invalidated_tags(session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            tags = MODEL_TAGS.get(type(obj))
+            if tags:
+                session.info.setdefault('invalidate_tags', set()).update(tags)
+
+    @event.listens_for(Session, 'do_orm_execute')
+    def collect_bulk_invalidated_tags(orm_execute_state):
+        # Query.update()/delete() skip the flush; opt out with execution_options(invalidate_cache=False)
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        mapper = orm_execute_state.bind_mapper
+        tags = MODEL_TAGS.get(mapper.class_) if mapper is not None else None
+        if tags and orm_execute_state.execution_options.get('invalidate_cache', True):
+            orm_execute_state.session.info.setdefault('invalidate_tags', set()).update(tags)
+
+    @event.listens_for(Session, 'after_commit')
+    def invalidate_after_commit(session):
+        tags = session.info.pop('invalidate_tags', None)
+        if tags:
+            cache.invalidate_tags(tags)
+
+    @event.listens_for(Session, 'after_rollback')
+    def forget_after_rollback(session):
+        session.info.pop('invalidate_tags', None)
@@ -0,0 +1,86 @@
+"""Gzip/Brotli compression of dynamic responses.
+
+Text responses (HTML, JSON, CSS, JS, SVG, XML) of at least
+COMPRESS_MIN_BYTES are compressed with the best encoding the client
+accepts: Brotli when the optional `brotli` package is installed, gzip
+otherwise. Dynamic responses use fast levels (COMPRESS_LEVEL,
+COMPRESS_BROTLI_QUALITY); static files are compressed once at their
+highest levels by `flask build-assets` instead (see assets.py), and the
+page cache stores compressed copies of the pages it keeps.
+"""
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'text/xml', 'application/javascript',
+    'application/json', 'application/xml', 'image/svg+xml', 'application/manifest+json',
+}
+
+# Preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Highest levels, for content compressed once and served many times
+BEST_LEVELS = {'gzip': 9, 'br': 11}
+# Pages stored by the page cache: compressed on a miss, so Brotli stays below its slowest levels
+STORED_LEVELS = {'gzip': 9, 'br': 9}
+
+
+def accepted_encoding(available=ENCODINGS):
+    """The first of `available` that the request accepts, or None"""
+    for encoding in available:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compressed_variants(data, levels, min_bytes=0):
+    """{encoding: compressed data} for every supported encoding that saves space"""
+    variants = {}
+    if len(data) < min_bytes:
+        return variants
+    for encoding in ENCODINGS:
+        compressed = compress(data, encoding, levels[encoding])
+        if len(compressed) < len(data):
+            variants[encoding] = compressed
+    return variants
+
+
+def is_compressible(response):
+    return (response.mimetype in COMPRESSIBLE_MIMETYPES and not response.direct_passthrough
+            and not response.is_streamed and 'Content-Encoding' not in response.headers
+            and 200 <= response.status_code < 300 and response.status_code not in (204, 206))
+
+
+def init_compression(app):
+    """Compress text responses the client accepts compressed"""
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return
+    min_bytes = app.config.get('COMPRESS_MIN_BYTES', 1024)
+    levels = {'gzip': app.config.get('COMPRESS_LEVEL', 6), 'br': app.config.get('COMPRESS_BROTLI_QUALITY', 4)}
+
+    @app.after_request
+    def compress_response(response):
+        if request.method == 'HEAD' or not is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = accepted_encoding()
+        if encoding is None or response.content_length is None or response.content_length < min_bytes:
+            return response
+        response.set_data(compress(response.get_data(), encoding, levels[encoding]))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
@@ -0,0 +1,168 @@
+"""Engine tuning for running on SQLite in production.
+
+Every new SQLite connection gets the pragmas in SQLITE_PRAGMAS (WAL,
+busy timeout, mmap, cache size...), ORM write transactions are serialized
+across threads and gunicorn workers by a writer lock taken at the first
+flush, and `retry_on_locked` retries a whole write with backoff when
+SQLite still reports the database as locked or busy.
+"""
+import fcntl
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from metrics import DB_LOCK_RETRIES, DB_LOCK_WAIT
+from models import db
+
+logger = logging.getLogger('adsvairl.database')
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,          # ms to wait on a lock before SQLITE_BUSY
+    'mmap_size': 268435456,        # 256 MB memory-mapped reads
+    'cache_size': -65536,          # 64 MB page cache (negative = KiB)
+    'temp_store': 'MEMORY',
+}
+
+
+class WriterLock:
+    """Process-wide and cross-process lock held by one write transaction.
+
+    The thread lock serializes writers inside a worker, the flock on
+    `<database>.write-lock` serializes gunicorn workers, so SQLite never
+    has two transactions racing to upgrade to a write lock.
+    """
+
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            raise OperationalError('acquire writer lock', {}, Exception('database is locked'))
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            while True:
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    DB_LOCK_WAIT.observe(time.monotonic() - started)
+                    return
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise OperationalError('acquire writer lock', {}, Exception('database is locked'))
+                    time.sleep(0.005)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def reset_after_fork(self):
+        # The parent's descriptor shares its flock; open a fresh one
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+
+def is_locked_error(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def retry_on_locked(attempts=5, base_delay=0.05):
+    """Retry a function running a full write transaction when SQLite is busy.
+
+    The session is rolled back between attempts with jittered exponential
+    backoff, so the wrapped function must build its changes from scratch.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return f(*args, **kwargs)
+                except OperationalError as e:
+                    db.session.rollback()
+                    if not is_locked_error(e) or attempt == attempts - 1:
+                        raise
+                    delay = base_delay * (2 ** attempt) * (1 + random.random())
+                    DB_LOCK_RETRIES.labels(f.__name__).inc()
+                    logger.warning('Database locked in %s, retrying in %.3fs', f.__name__, delay)
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+
+def configure_sqlite(app, engine):
+    """Apply SQLITE_PRAGMAS on connect and serialize ORM write transactions"""
+    pragmas = dict(SQLITE_PRAGMAS, **app.config.get('SQLITE_PRAGMAS', {}))
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    if not app.config.get('SQLITE_SERIALIZE_WRITES', True) or engine.url.database in (None, '', ':memory:'):
+        return None
+
+    writer_lock = WriterLock(f'{engine.url.database}.write-lock')
+    holders = set()
+
+    def acquire_for(session):
+        if session.get_bind() is engine and id(session) not in holders:
+            writer_lock.acquire()
+            holders.add(id(session))
+
+    @event.listens_for(Session, 'before_flush')
+    def acquire_writer_lock(session, flush_context, instances):
+        acquire_for(session)
+
+    @event.listens_for(Session, 'do_orm_execute')
+    def acquire_writer_lock_for_dml(orm_execute_state):
+        # Bulk UPDATE/DELETE/INSERT statements bypass the flush
+        if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+            acquire_for(orm_execute_state.session)
+
+    @event.listens_for(Session, 'after_transaction_end')
+    def release_writer_lock(session, transaction):
+        if transaction.parent is None and id(session) in holders:
+            holders.discard(id(session))
+            writer_lock.release()
+
+    os.register_at_fork(after_in_child=writer_lock.reset_after_fork)
+    return writer_lock
+
+
+def configure_database(app):
+    """Per-dialect engine setup, run once the app is configured"""
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name == 'sqlite' and app.config.get('SQLITE_PRODUCTION_MODE', True):
+            configure_sqlite(app, engine)
+
+
+def dispose_engines(app, close=True):
+    """Drop pooled connections of every engine (binds included).
+
+    In a forked worker pass close=False so the parent's connections are
+    forgotten rather than closed under it.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
@@ -0,0 +1,282 @@
+"""Synthetic data for load testing (`flask --app app generate-data`).
+
+Rows are built as plain dicts from a seeded random generator and written
+with Core `insert()` executemany batches, so a million ads take minutes.
+Core inserts skip the ORM events, so the generator assigns everything
+they would have: `seq` values (reserved in one block per table from the
+key allocator), the ads' integer foreign key copies, slugs and expiry
+dates. The same seed against an empty database gives the same data.
+"""
+import math
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from images import describe_image
+from keys import key_allocator
+from models import (
+    db, create_slug, User, MerchantStore, Category, Country, State, City, Ad, VIPPackage, VIPSubscription,
+)
+
+# (name, name_en, code, currency)
+COUNTRIES = [
+    ('المملكة العربية السعودية', 'Saudi Arabia', 'SA', 'SAR'),
+    ('الإمارات العربية المتحدة', 'UAE', 'AE', 'AED'),
+    ('مصر', 'Egypt', 'EG', 'EGP'),
+    ('الكويت', 'Kuwait', 'KW', 'KWD'),
+    ('قطر', 'Qatar', 'QA', 'QAR'),
+    ('البحرين', 'Bahrain', 'BH', 'BHD'),
+    ('عمان', 'Oman', 'OM', 'OMR'),
+    ('الأردن', 'Jordan', 'JO', 'JOD'),
+    ('المغرب', 'Morocco', 'MA', 'MAD'),
+    ('العراق', 'Iraq', 'IQ', 'IQD'),
+]
+
+DEFAULT_CATEGORIES = [
+    ('عقارات', 'Real Estate', 'fas fa-home', '#3B82F6'),
+    ('سيارات', 'Cars', 'fas fa-car', '#EF4444'),
+    ('وظائف', 'Jobs', 'fas fa-briefcase', '#10B981'),
+    ('إلكترونيات', 'Electronics', 'fas fa-laptop', '#8B5CF6'),
+    ('أثاث', 'Furniture', 'fas fa-couch', '#F59E0B'),
+    ('أزياء', 'Fashion', 'fas fa-tshirt', '#EC4899'),
+]
+
+# (Arabic, English) item names used in ad titles
+ITEMS = [
+    ('شقة', 'Apartment'), ('فيلا', 'Villa'), ('أرض', 'Land'), ('تويوتا كامري', 'Toyota Camry'),
+    ('هيونداي إلنترا', 'Hyundai Elantra'), ('مرسيدس', 'Mercedes'), ('آيفون 15', 'iPhone 15'),
+    ('سامسونج جالكسي', 'Samsung Galaxy'), ('لابتوب ديل', 'Dell laptop'), ('ماك بوك', 'MacBook'),
+    ('كنب', 'Sofa'), ('غرفة نوم', 'Bedroom set'), ('طاولة طعام', 'Dining table'), ('مكيف', 'Air conditioner'),
+    ('ساعة', 'Watch'), ('فستان', 'Dress'), ('حقيبة', 'Handbag'), ('دراجة', 'Bicycle'), ('كاميرا', 'Camera'),
+]
+AR_TITLES = ['{item} للبيع', '{item} بحالة ممتازة', '{item} مستعمل نظيف', '{item} جديد بالكرتون', 'فرصة: {item} بسعر مميز']
+EN_TITLES = ['{item} for sale', '{item} in excellent condition', 'Used {item}, very clean', 'Brand new {item}']
+AR_DESCRIPTIONS = ['استخدام خفيف', 'السعر قابل للتفاوض', 'التواصل عبر الهاتف فقط', 'التوصيل متاح',
+                   'بحالة الوكالة', 'بدون أي عيوب', 'الضمان ساري']
+EN_DESCRIPTIONS = ['Lightly used', 'Price negotiable', 'Call only', 'Delivery available', 'No defects',
+                   'Still under warranty']
+
+
+class Generator:
+    """Builds and inserts the rows of one generate_data() run"""
+
+    def __init__(self, seed, batch_size, log):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.batch_size = batch_size
+        self.log = log
+        self.now = datetime.utcnow()
+
+    def uuid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def seqs(self, model, count):
+        if not count:
+            return iter(())
+        return iter(key_allocator.reserve_range(db.session.connection(), model, count))
+
+    def insert(self, model, rows):
+        """executemany `rows` in batches, committing after each batch"""
+        started = time.perf_counter()
+        table = model.__table__
+        for start in range(0, len(rows), self.batch_size):
+            db.session.execute(table.insert(), rows[start:start + self.batch_size])
+            db.session.commit()
+        elapsed = time.perf_counter() - started
+        self.log(f'{table.name}: {len(rows)} rows in {elapsed:.1f}s')
+
+    def insert_stream(self, model, total, make_row):
+        """Insert `total` rows built by make_row(i) without holding them all in memory"""
+        started = time.perf_counter()
+        table = model.__table__
+        batch = []
+        for i in range(total):
+            batch.append(make_row(i))
+            if len(batch) >= self.batch_size:
+                db.session.execute(table.insert(), batch)
+                db.session.commit()
+                batch = []
+                if (i + 1) % (self.batch_size * 20) == 0:
+                    rate = (i + 1) / (time.perf_counter() - started)
+                    self.log(f'{table.name}: {i + 1}/{total} ({rate:.0f} rows/s)')
+        if batch:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+        self.log(f'{table.name}: {total} rows in {time.perf_counter() - started:.1f}s')
+
+    def categories(self):
+        existing = Category.query.filter_by(is_active=True).all()
+        if existing:
+            return [(category.id, category.seq, category.ad_ttl_days) for category in existing]
+        seqs = self.seqs(Category, len(DEFAULT_CATEGORIES))
+        rows = [{
+            'id': self.uuid(), 'seq': next(seqs), 'name': name, 'name_en': name_en, 'icon': icon,
+            'color': color, 'display_order': order, 'is_active': True, 'created_at': self.now,
+            'updated_at': self.now,
+        } for order, (name, name_en, icon, color) in enumerate(DEFAULT_CATEGORIES)]
+        self.insert(Category, rows)
+        return [(row['id'], row['seq'], None) for row in rows]
+
+    def locations(self, countries, states_per_country, cities_per_state):
+        """[(country, state, city) rows as (id, seq) pairs] for the first `countries` countries"""
+        existing = {country.code: country for country in Country.query.all()}
+        country_rows, state_rows, city_rows = [], [], []
+        country_keys = []
+        new_countries = [entry for entry in COUNTRIES[:countries] if entry[2] not in existing]
+        seqs = self.seqs(Country, len(new_countries))
+        for order, (name, name_en, code, currency) in enumerate(COUNTRIES[:countries]):
+            if code in existing:
+                country_keys.append((existing[code].id, existing[code].seq, currency))
+                continue
+            row = {'id': self.uuid(), 'seq': next(seqs), 'name': name, 'name_en': name_en, 'code': code,
+                   'currency': currency, 'is_active': True, 'sort_order': order,
+                   'created_at': self.now, 'updated_at': self.now}
+            country_rows.append(row)
+            country_keys.append((row['id'], row['seq'], currency))
+        self.insert(Country, country_rows)
+
+        state_seqs = self.seqs(State, len(country_keys) * states_per_country)
+        city_seqs = self.seqs(City, len(country_keys) * states_per_country * cities_per_state)
+        places = []
+        for country_id, country_seq, currency in country_keys:
+            for s in range(states_per_country):
+                state = {'id': self.uuid(), 'seq': next(state_seqs), 'name': f'منطقة {s + 1}',
+                         'name_en': f'Region {s + 1}', 'country_id': country_id, 'is_active': True,
+                         'sort_order': s, 'created_at': self.now, 'updated_at': self.now}
+                state_rows.append(state)
+                for c in range(cities_per_state):
+                    city = {'id': self.uuid(), 'seq': next(city_seqs), 'name': f'مدينة {s + 1}-{c + 1}',
+                            'name_en': f'City {s + 1}-{c + 1}', 'state_id': state['id'], 'is_active': True,
+                            'sort_order': c, 'created_at': self.now, 'updated_at': self.now}
+                    city_rows.append(city)
+                    places.append(((country_id, country_seq, currency), (state['id'], state['seq']),
+                                   (city['id'], city['seq'])))
+        self.insert(State, state_rows)
+        self.insert(City, city_rows)
+        return places
+
+    def users(self, count, vip_share, store_share):
+        seqs = self.seqs(User, count)
+        # One shared hash: hashing per row would dominate the run time
+        password_hash = generate_password_hash(f'loadtest-{self.seed}')
+        rows, vip_ids, store_owner_ids = [], [], []
+        for i in range(count):
+            is_vip = self.rng.random() < vip_share
+            row = {'id': self.uuid(), 'seq': next(seqs), 'username': f'loadtest_{self.seed}_{i}',
+                   'email': f'loadtest_{self.seed}_{i}@example.com', 'password_hash': password_hash,
+                   'phone': f'05{self.rng.randrange(10 ** 8):08d}', 'is_active': True, 'is_admin': False,
+                   'is_vip': is_vip, 'created_at': self.now - timedelta(days=self.rng.randint(0, 730))}
+            rows.append(row)
+            if is_vip:
+                vip_ids.append(row['id'])
+            if is_vip or self.rng.random() < store_share:
+                store_owner_ids.append(row['id'])
+        self.insert(User, rows)
+        return [(row['id'], row['seq']) for row in rows], set(vip_ids), store_owner_ids
+
+    def stores(self, owner_ids):
+        store_ids = {}
+        rows = []
+        for owner_id in owner_ids:
+            row = {'id': self.uuid(), 'owner_id': owner_id, 'name': f'متجر {len(rows) + 1}',
+                   'description': self.rng.choice(AR_DESCRIPTIONS), 'created_at': self.now, 'updated_at': self.now}
+            rows.append(row)
+            store_ids[owner_id] = row['id']
+        self.insert(MerchantStore, rows)
+        return store_ids
+
+    def subscriptions(self, vip_ids, country_keys):
+        packages = {}
+        for package in VIPPackage.query.filter_by(is_active=True).all():
+            packages.setdefault(package.country_id, package.id)
+        rows = []
+        for country_id, _, currency in country_keys:
+            if country_id not in packages:
+                row = {'id': self.uuid(), 'name': 'الباقة الذهبية', 'name_en': 'Gold', 'price': 100,
+                       'currency': currency, 'duration_days': 30, 'country_id': country_id,
+                       'featured_ads_count': 5, 'is_active': True,
+                       'created_at': self.now, 'updated_at': self.now}
+                rows.append(row)
+                packages[country_id] = row['id']
+        self.insert(VIPPackage, rows)
+
+        package_ids = list(packages.values())
+        subscription_rows = []
+        for user_id in sorted(vip_ids):
+            start = self.now - timedelta(days=self.rng.randint(0, 25))
+            subscription_rows.append({
+                'id': self.uuid(), 'user_id': user_id, 'package_id': self.rng.choice(package_ids),
+                'start_date': start, 'end_date': start + timedelta(days=30), 'payment_status': 'completed',
+                'payment_method': 'bank_transfer', 'is_active': True, 'created_at': start, 'updated_at': start,
+            })
+        self.insert(VIPSubscription, subscription_rows)
+
+
+def category_weights(count, skew):
+    """Zipf-like weights: the first category gets the most ads when skew > 0"""
+    return [1 / (rank + 1) ** skew for rank in range(count)]
+
+
+def generate_data(ads=100000, users=10000, countries=3, states_per_country=10, cities_per_state=10,
+                  category_skew=1.0, vip_share=0.05, store_share=0.02, max_images=5, english_share=0.2,
+                  days=90, seed=42, batch_size=5000, log=print):
+    """Insert a synthetic data set; returns the number of ads inserted"""
+    generator = Generator(seed, batch_size, log)
+    rng = generator.rng
+    default_ttl = current_app.config['AD_TTL_DAYS']
+
+    categories = generator.categories()
+    places = generator.locations(min(countries, len(COUNTRIES)), states_per_country, cities_per_state)
+    user_keys, vip_ids, store_owner_ids = generator.users(users, vip_share, store_share)
+    store_ids = generator.stores(store_owner_ids)
+    country_keys = list(dict.fromkeys(place[0] for place in places))
+    generator.subscriptions(vip_ids, country_keys)
+
+    weights = category_weights(len(categories), category_skew)
+    cumulative_weights = [sum(weights[:i + 1]) for i in range(len(weights))]
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    images = sorted(os.listdir(upload_folder)) if os.path.isdir(upload_folder) else []
+    image_meta = {image: describe_image(os.path.join(upload_folder, image)) for image in images}
+    ad_seqs = generator.seqs(Ad, ads)
+    seconds = days * 86400
+    slugs = {}  # Titles repeat a lot
+
+    def make_ad(i):
+        category_id, category_seq, category_ttl = rng.choices(categories, cum_weights=cumulative_weights)[0]
+        (country_id, country_seq, currency), (state_id, state_seq), (city_id, city_seq) = rng.choice(places)
+        user_id, user_seq = rng.choice(user_keys)
+        item_ar, item_en = rng.choice(ITEMS)
+        if rng.random() < english_share:
+            title = rng.choice(EN_TITLES).format(item=item_en)
+            description = '. '.join(rng.sample(EN_DESCRIPTIONS, rng.randint(1, 4)))
+        else:
+            title = rng.choice(AR_TITLES).format(item=item_ar)
+            description = '. '.join(rng.sample(AR_DESCRIPTIONS, rng.randint(1, 4)))
+        created_at = generator.now - timedelta(seconds=rng.randrange(seconds))
+        expires_at = created_at + timedelta(days=category_ttl or default_ttl)
+        image_count = min(len(images), rng.randint(0, max_images)) if images else 0
+        ad_images = rng.sample(images, image_count)
+        is_vip = user_id in vip_ids
+        if title not in slugs:
+            slugs[title] = create_slug(title)
+        return {
+            'id': generator.uuid(), 'seq': next(ad_seqs), 'title': title, 'slug': slugs[title],
+            'description': description, 'price': round(math.exp(rng.gauss(7, 1.8)), 2), 'currency': currency,
+            'images': ad_images, 'image_meta': {image: image_meta[image] for image in ad_images if image_meta[image]},
+            'user_id': user_id, 'category_id': category_id,
+            'country_id': country_id, 'state_id': state_id, 'city_id': city_id,
+            'store_id': store_ids.get(user_id), 'user_seq': user_seq, 'category_seq': category_seq,
+            'country_seq': country_seq, 'state_seq': state_seq, 'city_seq': city_seq,
+            'contact_phone': f'05{rng.randrange(10 ** 8):08d}', 'contact_email': None,
+            'is_featured': is_vip and rng.random() < 0.3, 'is_approved': rng.random() < 0.95,
+            'is_active': expires_at > generator.now, 'views_count': int(rng.expovariate(1 / 50)),
+            'expires_at': expires_at, 'created_at': created_at, 'updated_at': created_at,
+        }
+
+    generator.insert_stream(Ad, ads, make_ad)
+    return ads
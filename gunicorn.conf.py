@@ -0,0 +1,120 @@
+"""Production gunicorn settings (picked up automatically from the working directory).
+
+    gunicorn wsgi:app
+
+The app is imported and created once in the master (preload_app) and the
+caches are warmed there before forking, so workers boot in milliseconds
+and share that memory copy-on-write. Every worker then drops the
+database connections it inherited and warms its own (see warmup.py)
+before accepting requests.
+
+The VIP_SWEEP_INTERVAL/AD_SWEEP_INTERVAL maintenance jobs run in one
+extra process forked once the master is ready, never as a thread of the
+master: a sweep holding a connection or lock while the master forks a
+worker would hand that state to the child.
+"""
+import glob
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+_config_loaded = time.perf_counter()
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# More than one thread switches to the gthread worker
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Recycle workers after this many requests (0 disables), jittered so they don't all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+preload_app = True
+
+# Metric files left by the previous run would be added to this run's /metrics
+multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if multiproc_dir:
+    os.makedirs(multiproc_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+        os.remove(path)
+
+
+def when_ready(server):
+    """Master: the app is preloaded, warm its caches before the first fork"""
+    if server.cfg.preload_app:
+        from warmup import warm_up
+
+        app = server.app.wsgi()
+        warm_up_ms = warm_up(app)['timings']['total_ms'] if app.config['WARM_UP'] else 0
+        startup = app.extensions['startup']
+        server.log.info('Master ready in %.0f ms (import %.0f ms, create_app %.0f ms, warm-up %.0f ms)',
+                        (time.perf_counter() - _config_loaded) * 1000, startup.get('import_ms', 0),
+                        startup['create_app_ms'], warm_up_ms)
+    start_scheduler_process(server)
+
+
+def start_scheduler_process(server):
+    """Fork the process running the maintenance jobs (exits at once when none are enabled)"""
+    pid = os.fork()
+    if pid:
+        server.scheduler_pid = pid
+        return
+    status = 0
+    try:
+        # The master's handlers would only queue signals for its own loop
+        for sig in server.SIGNALS + [signal.SIGCHLD]:
+            signal.signal(sig, signal.SIG_DFL)
+        # Stopping (on_exit, or Ctrl-C/systemd signalling the whole group) is a clean exit, not a crash
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: sys.exit(0))
+        from database import dispose_engines
+        from maintenance import run_scheduler, scheduled_jobs
+
+        app = server.app.wsgi()
+        jobs = scheduled_jobs(app)
+        if jobs:
+            dispose_engines(app, close=False)
+            server.log.info('Maintenance scheduler %s running %s', os.getpid(),
+                            ', '.join(f'{job.__name__} every {interval}s' for job, interval in jobs.items()))
+            run_scheduler(app, jobs)
+    except Exception:
+        server.log.exception('Maintenance scheduler failed')
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def on_exit(server):
+    pid = getattr(server, 'scheduler_pid', None)
+    if pid:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+    if server.cfg.preload_app:
+        from database import dispose_engines
+
+        dispose_engines(server.app.wsgi(), close=False)
+
+
+def post_worker_init(worker):
+    """Worker: repeat the hot queries on this worker's own connections before serving"""
+    app = worker.wsgi
+    if app.config['WARM_UP']:
+        from warmup import warm_up
+
+        warm_up(app, dispose=False)
+    worker.log.info('Worker %s ready in %.0f ms', worker.pid, (time.perf_counter() - worker.forked_at) * 1000)
+
+
+def child_exit(server, worker):
+    from metrics import mark_worker_dead
+
+    mark_worker_dead(worker.pid)
@@ -0,0 +1,297 @@
+"""Resized upload images served from a bounded disk cache.
+
+`/img/<w>x<h>/<upload>.<fmt>` (e.g. /img/640x384/car.jpg.webp) returns the
+uploaded image scaled down and cropped to the box, or scaled to the width
+when h is 0, transcoded to webp, jpeg or png. The first request renders it
+with Pillow into IMAGE_CACHE_DIR; later ones are sent straight from disk
+(sendfile under gunicorn) with conditional request support. The cache is
+trimmed to IMAGE_CACHE_MAX_BYTES by evicting the least recently used
+files, and only the IMAGE_SIZES boxes are served, so it can't be filled
+with arbitrary sizes.
+
+Rendering is the expensive part: each process renders at most
+IMAGE_MAX_RENDERS images at once (503 when busy) and each client address
+at most IMAGE_RENDERS_PER_MINUTE (429 beyond it); cached images are never
+limited. Templates call `image_url(ad.images[0], 640, 384)`, which falls
+back to the original file when Pillow isn't installed or the size isn't
+configured, and returns URLs (anything containing '/') unchanged. Like
+asset_url(), its `?v=` changes with the upload and makes the response
+immutable.
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from flask import abort, current_app, redirect, request, send_file, url_for
+
+from assets import asset_url, file_version, make_immutable
+from metrics import record_cache_lookup
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:  # optional, templates link the original images
+    Image = None
+
+logger = logging.getLogger('adsvairl.images')
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+# A hit refreshes the file's mtime (its LRU position) at most this often
+TOUCH_INTERVAL = 3600
+# Longest side of the inline placeholder stored with each upload
+PLACEHOLDER_SIZE = 16
+ORIENTATION = 0x0112
+
+
+def parse_sizes(value):
+    """"640x384,1280x0" -> {(640, 384), (1280, 0)}"""
+    sizes = set()
+    for item in value.split(','):
+        if 'x' in item:
+            width, height = item.strip().split('x', 1)
+            sizes.add((int(width), int(height)))
+    return sizes
+
+
+class DiskCache:
+    """Files named by key under `directory`, evicted by mtime beyond `max_bytes`"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Bytes this process believes are stored; other workers' writes are picked up by prune()
+        self.size = None
+        self.written = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if time.time() - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except OSError:  # evicted meanwhile
+                return None
+        return path
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        with self.lock:
+            self.written += len(data)
+            if self.size is not None:
+                self.size += len(data)
+            due = self.size is None or self.size > self.max_bytes or self.written > self.max_bytes // 20
+        if due:
+            self.prune()
+        return path
+
+    def prune(self):
+        """Delete the least recently used files until the cache is at 90% of max_bytes"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        size = sum(item[1] for item in files)
+        removed = 0
+        if size > self.max_bytes:
+            files.sort()
+            for _, file_size, path in files:
+                if size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= file_size
+                removed += 1
+            logger.info('Evicted %d resized images, %d bytes left', removed, size)
+        with self.lock:
+            self.size = size
+            self.written = 0
+        return removed
+
+
+class RateLimiter:
+    """Token bucket per client: `rate` renders a minute, bursts up to `rate`"""
+
+    def __init__(self, rate, max_clients=10000):
+        self.rate = rate
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, client):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate / 60)
+            allowed = tokens >= 1
+            self.buckets[client] = (tokens - 1 if allowed else tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed
+
+
+def target_size(source_size, width, height):
+    """Box to render into: never larger than the source, same aspect ratio as the request"""
+    source_width, source_height = source_size
+    if not height:
+        width = min(width, source_width)
+        return width, max(1, round(source_height * width / source_width))
+    factor = min(1, source_width / width, source_height / height)
+    return max(1, round(width * factor)), max(1, round(height * factor))
+
+
+def render(path, width, height, fmt, quality):
+    """Encoded bytes of the image at `path` fitted to width x height"""
+    with Image.open(path) as image:
+        # JPEG can decode at 1/2, 1/4 or 1/8 scale directly (the box may still be rotated by EXIF)
+        box = max(target_size(image.size, width, height))
+        image.draft('RGB', (box, box))
+        image = ImageOps.exif_transpose(image)
+        size = target_size(image.size, width, height)
+        if height:
+            image = ImageOps.fit(image, size, Image.LANCZOS)
+        else:
+            image = image.resize(size, Image.LANCZOS)
+        format_name, _ = FORMATS[fmt]
+        if format_name == 'JPEG':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+        options = {
+            'WEBP': {'quality': quality, 'method': 4},
+            'JPEG': {'quality': quality, 'optimize': True, 'progressive': True},
+            'PNG': {'optimize': True},
+        }[format_name]
+        buffer = BytesIO()
+        image.save(buffer, format_name, **options)
+        return buffer.getvalue()
+
+
+def describe_image(path, max_decode_pixels=None):
+    """{'width', 'height', 'placeholder'} of an upload, None if Pillow is missing or can't decode it.
+
+    The placeholder is a tiny WebP data URI (a few hundred bytes) shown
+    blurred behind the image until it loads; width and height let the
+    browser reserve its box. JPEGs are decoded at 1/8 scale, other formats
+    only whole, so beyond `max_decode_pixels` those get just the size from
+    their header (backfill_image_meta adds the placeholder later).
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            # PngImageFile.getexif() decodes the whole image to look for an eXIf chunk after the pixels
+            exif = image.getexif() if image.format != 'PNG' or 'exif' in image.info else {}
+            orientation = exif.get(ORIENTATION, 1)
+            # EXIF orientations 5-8 are rotated by 90 degrees
+            if orientation in (5, 6, 7, 8):
+                width, height = height, width
+            if image.format != 'JPEG' and max_decode_pixels and width * height > max_decode_pixels:
+                return {'width': width, 'height': height}
+            image.draft('RGB', (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+            if orientation != 1:
+                image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.LANCZOS)
+            buffer = BytesIO()
+            # Fastest method: at 16px the slower ones save a few bytes at most
+            image.save(buffer, 'WEBP', quality=40, method=0)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning('Cannot read image %s', path, exc_info=True)
+        return None
+    placeholder = base64.b64encode(buffer.getvalue()).decode()
+    return {'width': width, 'height': height, 'placeholder': f'data:image/webp;base64,{placeholder}'}
+
+
+def image_key(filename, width, height, fmt, version):
+    return hashlib.sha1(f'{filename}|{width}x{height}|{fmt}|{version}'.encode()).hexdigest() + '.' + fmt
+
+
+def image_url(filename, width, height=0, fmt='webp'):
+    """URL of an upload resized to width x height (template global)"""
+    if '/' in filename:  # a URL rather than an upload name (e.g. older store logos)
+        return filename
+    if current_app.extensions.get('images') is None or (width, height) not in current_app.config.get('IMAGE_SIZES', ()):
+        return asset_url(f'uploads/{filename}')
+    version = file_version(current_app.config['UPLOAD_FOLDER'], filename)
+    return url_for('image', width=width, height=height, filename=f'{filename}.{fmt}', v=version)
+
+
+def init_images(app):
+    """Serve /img/<w>x<h>/<upload>.<fmt> and add image_url()"""
+    app.add_template_global(image_url)
+    if Image is None or not app.config.get('IMAGE_RESIZE_ENABLED', True):
+        app.extensions['images'] = None
+        return
+    directory = app.config.get('IMAGE_CACHE_DIR') or os.path.join(app.instance_path, 'image_cache')
+    disk_cache = DiskCache(directory, app.config.get('IMAGE_CACHE_MAX_BYTES', 1024 ** 3))
+    limiter = RateLimiter(app.config.get('IMAGE_RENDERS_PER_MINUTE', 120))
+    renders = threading.BoundedSemaphore(app.config.get('IMAGE_MAX_RENDERS', 2))
+    # Keys of uploads Pillow can't decode, redirected to the original without another attempt
+    undecodable = set()
+    app.extensions['images'] = disk_cache
+
+    @app.route('/img/<int:width>x<int:height>/<path:filename>')
+    def image(width, height, filename):
+        source, _, fmt = filename.rpartition('.')
+        if fmt not in FORMATS or (width, height) not in app.config['IMAGE_SIZES'] or '/' in source:
+            abort(404)
+        version = file_version(app.config['UPLOAD_FOLDER'], source)
+        if version is None:
+            abort(404)
+        key = image_key(source, width, height, fmt, version)
+        if key in undecodable:
+            return redirect(asset_url(f'uploads/{source}'))
+        path = disk_cache.get(key)
+        record_cache_lookup('image', path is not None)
+        if path is None:
+            if not limiter.allow(request.remote_addr):
+                return 'Too Many Requests', 429, {'Retry-After': '60'}
+            if not renders.acquire(timeout=5):
+                return 'Service Unavailable', 503, {'Retry-After': '5'}
+            try:
+                data = render(os.path.join(app.config['UPLOAD_FOLDER'], source), width, height, fmt,
+                              app.config.get('IMAGE_QUALITY', 80))
+            except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+                # Formats this Pillow can't decode (e.g. AVIF without the plugin) are sent as uploaded
+                logger.warning('Cannot resize %s, serving the original', source, exc_info=True)
+                undecodable.add(key)
+                return redirect(asset_url(f'uploads/{source}'))
+            finally:
+                renders.release()
+            path = disk_cache.put(key, data)
+        response = send_file(path, mimetype=FORMATS[fmt][1], conditional=True)
+        if request.args.get('v') == version:
+            return make_immutable(response)
+        return response
@@ -2,9 +2,11 @@
 import os
 from datetime import datetime
 from werkzeug.security import generate_password_hash
-from app import app
+from app import create_app
 from models import db, User, Category, Country, State, City, VIPPackage, VIPSubscription, MerchantStore, SiteSetting
 
+app = create_app()
+
 def init_database():
     """Initialize database with tables and sample data"""
     print("Creating database tables...")
@@ -0,0 +1,311 @@
+"""Per-request SQL instrumentation.
+
+SQLAlchemy cursor events count every statement and its duration into a
+RequestStats object on `g`. After each request the totals are sent as a
+`Server-Timing` header (to admins, or to everyone with SERVER_TIMING_PUBLIC),
+statements slower than SLOW_QUERY_MS are logged with their endpoint and
+parameter shape, and per-endpoint aggregates, including the
+QUERY_STATS_TOP_N slowest statements seen on each endpoint, are kept in
+memory. Each process writes its aggregates to QUERY_STATS_DIR at most every
+QUERY_STATS_FLUSH_SECONDS; the admin query stats page merges those files so
+it covers every gunicorn worker.
+"""
+import glob
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import current_app, g, has_request_context, request, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('adsvairl.sql')
+
+
+class RequestStats:
+    """Queries issued while handling one request"""
+
+    def __init__(self, top_n):
+        self.started = time.perf_counter()
+        self.top_n = top_n
+        self.query_count = 0
+        self.db_time = 0.0
+        self.slowest = []  # min-heap of (duration, statement, params shape), merged into EndpointStats
+        self.log = None  # every query, in order, when set to a list (profiled requests)
+
+    def record(self, statement, duration, params_shape):
+        self.query_count += 1
+        self.db_time += duration
+        if self.log is not None:
+            self.log.append((time.perf_counter() - self.started, duration, statement, params_shape))
+        entry = (duration, statement, params_shape)
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, entry)
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+
+class EndpointStats:
+    """Aggregated request and query totals per endpoint, for this process
+
+    With a directory set, flush() writes the totals to <pid>-<start>.json
+    there and merged_snapshot() combines the files of all processes. A
+    reset writes reset.json; processes clear their own totals when they
+    next see a newer one.
+    """
+
+    def __init__(self, slow_log_size=50):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self.directory = None
+        self.flush_interval = 5.0
+        self.top_n = 5
+        self._pid = None
+        self._started = 0.0
+        self._flushed_at = 0.0
+        self._reset_checked_at = 0.0
+        self._reset_seen = 0.0
+
+    def _check_pid(self):
+        # Forked workers inherit the master's totals (warm-up requests), which the master reports itself
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._started = self._reset_seen = time.time()
+            self._flushed_at = 0.0
+            self.endpoints.clear()
+            self.slow_queries.clear()
+
+    def _check_reset(self, force=False):
+        """Clear this process's totals if another process reset them (checked at most once a second)"""
+        now = time.monotonic()
+        if self.directory is None or (not force and now - self._reset_checked_at < 1.0):
+            return
+        self._reset_checked_at = now
+        try:
+            reset_at = os.path.getmtime(self._reset_path)
+        except OSError:
+            return
+        if reset_at > self._reset_seen:
+            self._reset_seen = reset_at
+            self.endpoints.clear()
+            self.slow_queries.clear()
+
+    def add_request(self, endpoint, stats, duration):
+        with self._lock:
+            self._check_pid()
+            self._check_reset()
+            entry = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'queries': 0, 'db_time': 0.0, 'total_time': 0.0,
+                'max_time': 0.0, 'max_queries': 0, 'slowest': {},
+            })
+            entry['requests'] += 1
+            entry['queries'] += stats.query_count
+            entry['db_time'] += stats.db_time
+            entry['total_time'] += duration
+            entry['max_time'] = max(entry['max_time'], duration)
+            entry['max_queries'] = max(entry['max_queries'], stats.query_count)
+            # Worst duration per statement, trimmed to the request's top_n
+            slowest = entry['slowest']
+            for duration, statement, params_shape in stats.slowest:
+                if duration > slowest.get(statement, (0.0,))[0]:
+                    slowest[statement] = (duration, params_shape)
+            if len(slowest) > stats.top_n:
+                keep = heapq.nlargest(stats.top_n, slowest.items(), key=lambda item: item[1][0])
+                entry['slowest'] = dict(keep)
+
+    def add_slow_query(self, endpoint, statement, duration, params_shape):
+        with self._lock:
+            self._check_pid()
+            self._check_reset()
+            self.slow_queries.appendleft({
+                'endpoint': endpoint, 'statement': statement, 'duration': duration,
+                'params': params_shape, 'at': datetime.utcnow(),
+            })
+
+    @property
+    def _reset_path(self):
+        return os.path.join(self.directory, 'reset.json')
+
+    def flush(self, force=False):
+        """Write this process's totals for the other workers to read"""
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._flushed_at < self.flush_interval:
+                return
+            self._flushed_at = now
+            self._check_pid()
+            self._check_reset(force=True)
+            data = {
+                'pid': self._pid,
+                'endpoints': {endpoint: dict(entry, slowest=dict(entry['slowest']))
+                              for endpoint, entry in self.endpoints.items()},
+                'slow_queries': [dict(query, at=query['at'].isoformat()) for query in self.slow_queries],
+            }
+            path = os.path.join(self.directory, f'{self._pid}-{self._started:.0f}.json')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError:
+            logger.exception('Could not write query stats to %s', path)
+
+    def _process_files(self):
+        """Totals of every process since the last reset, this one included"""
+        if self.directory is None:
+            with self._lock:
+                self._check_pid()
+                return [{'pid': self._pid, 'endpoints': dict(self.endpoints),
+                         'slow_queries': list(self.slow_queries)}]
+        self.flush(force=True)
+        processes = []
+        for path in glob.glob(os.path.join(self.directory, '*-*.json')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for query in data['slow_queries']:
+                query['at'] = datetime.fromisoformat(query['at'])
+            processes.append(data)
+        return processes
+
+    def snapshot(self):
+        """(endpoint rows, recent slow queries, pids) merged across processes"""
+        rows = {}
+        slow = []
+        pids = []
+        for process in self._process_files():
+            pids.append(process['pid'])
+            slow.extend(process['slow_queries'])
+            for endpoint, entry in process['endpoints'].items():
+                row = rows.setdefault(endpoint, {
+                    'endpoint': endpoint, 'requests': 0, 'queries': 0, 'db_time': 0.0, 'total_time': 0.0,
+                    'max_time': 0.0, 'max_queries': 0, 'slowest': {}, 'pids': [],
+                })
+                for key in ('requests', 'queries', 'db_time', 'total_time'):
+                    row[key] += entry[key]
+                row['max_time'] = max(row['max_time'], entry['max_time'])
+                row['max_queries'] = max(row['max_queries'], entry['max_queries'])
+                row['pids'].append(process['pid'])
+                for statement, (duration, params_shape) in entry['slowest'].items():
+                    if duration > row['slowest'].get(statement, (0.0,))[0]:
+                        row['slowest'][statement] = (duration, params_shape)
+        rows = list(rows.values())
+        for row in rows:
+            row['top_queries'] = sorted(
+                ({'statement': statement, 'duration': duration, 'params': params_shape}
+                 for statement, (duration, params_shape) in row.pop('slowest').items()),
+                key=lambda query: query['duration'], reverse=True)[:self.top_n]
+            row['avg_time'] = row['total_time'] / row['requests']
+            row['avg_db_time'] = row['db_time'] / row['requests']
+            row['avg_queries'] = row['queries'] / row['requests']
+        rows.sort(key=lambda row: row['db_time'], reverse=True)
+        slow.sort(key=lambda query: query['at'], reverse=True)
+        return rows, slow[:self.slow_queries.maxlen], sorted(pids)
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+            self.slow_queries.clear()
+            self._reset_seen = time.time()
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._reset_path, 'w') as f:
+            json.dump({'at': datetime.utcnow().isoformat()}, f)
+        self._reset_seen = os.path.getmtime(self._reset_path)
+        for path in glob.glob(os.path.join(self.directory, '*-*.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+endpoint_stats = EndpointStats()
+
+
+def params_shape(parameters, executemany=False):
+    """Describe bound parameters by type only, never logging their values"""
+    if executemany and parameters:
+        return f'{len(parameters)} x {params_shape(parameters[0])}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return type(parameters).__name__
+
+
+def current_request_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+def server_timing_allowed():
+    """Server-Timing exposes backend timings, so by default only admins get it"""
+    if current_app.config.get('SERVER_TIMING_PUBLIC'):
+        return True
+    # Only look into the session when a cookie was sent, so anonymous responses don't get Vary: Cookie
+    if current_app.config['SESSION_COOKIE_NAME'] not in request.cookies:
+        return False
+    return 'admin_id' in session
+
+
+def init_instrumentation(app):
+    """Register query hooks on all engines and the per-request bookkeeping"""
+    if not app.config.get('SQL_INSTRUMENTATION', True):
+        return
+    slow_query_seconds = app.config.get('SLOW_QUERY_MS', 100) / 1000.0
+    top_n = app.config.get('QUERY_STATS_TOP_N', 5)
+    endpoint_stats.directory = app.config.get('QUERY_STATS_DIR') or os.path.join(app.instance_path, 'query_stats')
+    endpoint_stats.flush_interval = app.config.get('QUERY_STATS_FLUSH_SECONDS', 5)
+    endpoint_stats.top_n = top_n
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start'].pop()
+        stats = current_request_stats()
+        if stats is None and duration < slow_query_seconds:
+            return
+        shape = params_shape(parameters, executemany)
+        endpoint = request.endpoint if has_request_context() else None
+        if stats is not None:
+            stats.record(statement, duration, shape)
+        if duration >= slow_query_seconds:
+            endpoint_stats.add_slow_query(endpoint, statement, duration, shape)
+            logger.warning('Slow query (%.1f ms) in %s: %s params=%s',
+                           duration * 1000, endpoint, statement, shape)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats(top_n)
+
+    @app.after_request
+    def add_server_timing(response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        duration = time.perf_counter() - stats.started
+        endpoint_stats.add_request(request.endpoint or 'unknown', stats, duration)
+        endpoint_stats.flush()
+        if not server_timing_allowed():
+            return response
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.query_count} queries", '
+            f'app;dur={duration * 1000:.1f}'
+        )
+        return response
@@ -0,0 +1,173 @@
+"""Compact integer surrogate keys alongside the public UUID primary keys.
+
+Rows of the tables in SEQ_MODELS get a BigInteger `seq` handed out in
+blocks from the key_allocation table, and every Ad stores the `seq` of its
+user, category and location rows. Only the ad listing filters use them
+(filter_ads_by_key), through integer indexes in place of unindexed string
+scans. The UUIDs stay the primary and foreign keys, so joins,
+relationships, writes and URLs still use them; moving those over means
+rebuilding the tables and is not part of this scheme.
+"""
+import os
+import threading
+
+from flask import current_app
+from sqlalchemy import event, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from cache import cache
+from metrics import record_cache_lookup
+from models import db, User, Ad, Category, Country, State, City, KeyAllocation, SiteSetting
+
+SEQ_MODELS = (User, Ad, Category, Country, State, City)
+
+# Ad foreign key -> (integer copy column, referenced model)
+AD_SEQ_FOREIGN_KEYS = {
+    'user_id': ('user_seq', User),
+    'category_id': ('category_seq', Category),
+    'country_id': ('country_seq', Country),
+    'state_id': ('state_seq', State),
+    'city_id': ('city_seq', City),
+}
+
+# Lookup tables are small and their seq never changes once assigned
+CACHED_SEQ_MODELS = (Category, Country, State, City)
+
+# SiteSetting written by migrate_integer_keys once every ad is linked
+MIGRATED_SETTING = 'integer_keys_migrated'
+
+
+class KeyAllocator:
+    """Hands out `seq` values from blocks reserved in key_allocation.
+
+    Blocks are reserved on the flushing connection, inside the caller's
+    transaction, so a separate writer never waits on a SQLite lock held by
+    the same request. Each thread owns its blocks and drops them when its
+    transaction rolls back, since the reservation is rolled back too.
+    """
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._local = threading.local()
+
+    def _blocks(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            # Forked worker: never reuse blocks reserved by the parent
+            self._local.pid = os.getpid()
+            self._local.blocks = {}
+        return self._local.blocks
+
+    def reset(self):
+        self._blocks().clear()
+
+    def next_value(self, connection, model):
+        blocks = self._blocks()
+        name = model.__tablename__
+        current, end = blocks.get(name, (0, 0))
+        if current >= end:
+            current, end = self._reserve(connection, model)
+        blocks[name] = (current + 1, end)
+        return current
+
+    def _reserve(self, connection, model, size=None):
+        size = size or self.block_size
+        name = model.__tablename__
+        table = KeyAllocation.__table__
+        for _ in range(3):
+            end = connection.execute(
+                update(table).where(table.c.name == name)
+                .values(next_value=table.c.next_value + size)
+                .returning(table.c.next_value)
+            ).scalar()
+            if end is not None:
+                return end - size, end
+            # First allocation for this table: start above any existing seq
+            start = connection.execute(select(func.max(model.__table__.c.seq))).scalar() or 0
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert().values(name=name, next_value=start + 1))
+            except IntegrityError:
+                pass  # Another worker created it first
+        raise RuntimeError(f'Could not reserve keys for {name}')
+
+    def reserve_range(self, connection, model, count):
+        """Reserve `count` consecutive values for rows inserted outside the ORM"""
+        start, end = self._reserve(connection, model, count)
+        return range(start, end)
+
+
+key_allocator = KeyAllocator()
+_seq_cache = {}
+
+
+def seq_for(connection, model, row_id):
+    """Return the seq of `model` row `row_id`, caching small lookup tables"""
+    if not row_id:
+        return None
+    cache_key = (model.__tablename__, row_id)
+    cacheable = model in CACHED_SEQ_MODELS
+    if cacheable:
+        record_cache_lookup('seq', cache_key in _seq_cache)
+    if cache_key in _seq_cache:
+        return _seq_cache[cache_key]
+    seq = connection.execute(select(model.__table__.c.seq).where(model.__table__.c.id == row_id)).scalar()
+    if seq is not None and cacheable:
+        _seq_cache[cache_key] = seq
+    return seq
+
+
+def prime_seq_cache(connection):
+    """Load the seq of every row of the cached lookup tables"""
+    for model in CACHED_SEQ_MODELS:
+        table = model.__table__
+        for row_id, seq in connection.execute(select(table.c.id, table.c.seq).where(table.c.seq.isnot(None))):
+            _seq_cache[(model.__tablename__, row_id)] = seq
+
+
+def integer_keys_enabled():
+    """INTEGER_KEYS_ENABLED, or when it is unset whether `flask migrate-keys` has completed.
+
+    Until then some ads may lack their integer copies, and filtering on
+    them would leave those ads out of the listings.
+    """
+    enabled = current_app.config.get('INTEGER_KEYS_ENABLED')
+    if enabled is None:
+        # Same entry as get_site_setting(), dropped with the 'settings' tag when the marker is written
+        marker = cache.get_or_set(f'setting:{MIGRATED_SETTING}', lambda: db.session.query(SiteSetting.value)
+                                  .filter_by(key=MIGRATED_SETTING).scalar(), ttl=3600, tags=('settings',))
+        enabled = marker is not None
+    return enabled
+
+
+def filter_ads_by_key(query, fk_name, row_id):
+    """Filter an Ad query on `fk_name`, via its indexed integer copy once integer_keys_enabled()"""
+    seq_name, model = AD_SEQ_FOREIGN_KEYS[fk_name]
+    if integer_keys_enabled():
+        seq = seq_for(db.session.connection(), model, row_id)
+        if seq is not None:
+            return query.filter(getattr(Ad, seq_name) == seq)
+    return query.filter(getattr(Ad, fk_name) == row_id)
+
+
+def assign_seq(mapper, connection, target):
+    if target.seq is None:
+        target.seq = key_allocator.next_value(connection, type(target))
+
+
+def sync_ad_seq_columns(mapper, connection, target):
+    state = db.inspect(target)
+    for fk_name, (seq_name, model) in AD_SEQ_FOREIGN_KEYS.items():
+        if state.pending or getattr(state.attrs, fk_name).history.has_changes():
+            setattr(target, seq_name, seq_for(connection, model, getattr(target, fk_name)))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_key_blocks(session):
+    key_allocator.reset()
+
+
+for _model in SEQ_MODELS:
+    event.listen(_model, 'before_insert', assign_seq)
+event.listen(Ad, 'before_insert', sync_ad_seq_columns)
+event.listen(Ad, 'before_update', sync_ad_seq_columns)
@@ -0,0 +1,185 @@
+"""Non-blocking JSON logging.
+
+Request threads only put records on a bounded in-memory queue through a
+QueueHandler (records are dropped when it is full and counted in
+adsvairl_log_records_dropped_total on /metrics); a
+QueueListener thread formats them as one JSON object per line and does
+the file I/O. Every record carries the id of the request that logged it,
+which is also returned in the X-Request-ID header.
+
+DEBUG records are sampled per request (LOG_DEBUG_SAMPLE_RATE), levels can
+be set per logger with LOG_LEVELS ("adsvairl.sql=WARNING,werkzeug=ERROR"),
+and the file is reopened after an external logrotate. LOG_MAX_BYTES
+rotates it in-process instead, which is only safe with a single process:
+gunicorn workers would each rotate the same file.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+
+from metrics import record_log_drop, track_queue
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# LogRecord attributes that are not `extra=` fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'request_id', 'endpoint'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, including any `extra=` fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        for key in ('request_id', 'endpoint'):
+            if getattr(record, key, None):
+                entry[key] = getattr(record, key)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the current request id and endpoint"""
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.endpoint = request.endpoint
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keep DEBUG records for a sample of requests only"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        if not has_request_context():
+            return random.random() < self.rate
+        if 'log_debug_sampled' not in g:
+            g.log_debug_sampled = random.random() < self.rate
+        return g.log_debug_sampled
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never waits: a full queue drops the record"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render the message and traceback now, in the logging thread,
+        # but leave JSON formatting to the listener
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            record_log_drop()
+
+
+def parse_levels(value):
+    levels = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def file_handler(path, max_bytes, backup_count):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if max_bytes:
+        return RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    return WatchedFileHandler(path, encoding='utf-8')
+
+
+def init_logging(app):
+    """Route all loggers through the queue and start the writer thread"""
+    log_queue = queue.Queue(app.config.get('LOG_QUEUE_SIZE', 10000))
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(RequestContextFilter())
+    handler.addFilter(DebugSamplingFilter(app.config.get('LOG_DEBUG_SAMPLE_RATE', 0.01)))
+
+    output = file_handler(app.config.get('LOG_FILE', 'logs/adsvairl.log'),
+                          app.config.get('LOG_MAX_BYTES', 0),
+                          app.config.get('LOG_BACKUP_COUNT', 10))
+    output.setFormatter(JsonFormatter())
+    outputs = [output]
+    if app.config.get('LOG_TO_STDERR', app.debug):
+        stderr = logging.StreamHandler(sys.stderr)
+        stderr.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        outputs.append(stderr)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(logging.NOTSET)
+    for name, level in parse_levels(app.config.get('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = QueueListener(log_queue, *outputs, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_in_child():
+        # The writer thread does not survive a fork (gunicorn --preload) and
+        # the old queue's lock may have been held by it
+        handler.queue = listener.queue = queue.Queue(log_queue.maxsize)
+        listener._thread = None
+        listener.start()
+        track_queue('log', handler.queue.qsize)
+
+    os.register_at_fork(after_in_child=restart_in_child)
+    track_queue('log', log_queue.qsize)
+
+    @app.before_request
+    def assign_request_id():
+        request_id = request.headers.get('X-Request-ID', '')
+        g.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+
+    @app.after_request
+    def add_request_id_header(response):
+        if g.get('request_id'):
+            response.headers['X-Request-ID'] = g.request_id
+        return response
+
+    return listener
@@ -0,0 +1,373 @@
+"""Background maintenance jobs: schema upgrades, expiry sweepers and the
+scheduler thread that runs them without an external cron."""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import inspect, insert, or_, and_, select, text, update
+
+from models import (
+    db, User, Ad, AdArchive, Category, Country, State, City, SiteSetting, VIPPackage, VIPSubscription, create_slug
+)
+from keys import key_allocator, AD_SEQ_FOREIGN_KEYS, MIGRATED_SETTING
+from images import describe_image
+
+logger = logging.getLogger('adsvairl.maintenance')
+
+SWEEP_BATCH_SIZE = 500
+
+# Indexes dropped from the models that upgrade_schema removes from existing databases
+OBSOLETE_INDEXES = ('ix_user_seq', 'ix_ad_seq', 'ix_category_seq', 'ix_country_seq', 'ix_state_seq', 'ix_city_seq')
+
+
+def add_missing_columns():
+    """Add nullable columns declared on the models but missing in the database"""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logger.info('Added column %s.%s', table.name, column.name)
+
+
+def upgrade_schema():
+    """Create missing tables, columns and indexes on an existing database"""
+    db.create_all()
+    add_missing_columns()
+    with db.engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def backfill_ad_slugs(batch_size=SWEEP_BATCH_SIZE, recompute=False):
+    """Store slugs for ads saved before Ad.slug existed.
+
+    With `recompute` every row is rewritten (e.g. after changing
+    create_slug), walking the table by primary key.
+    """
+    updated = 0
+    last_id = ''
+    while True:
+        query = db.session.query(Ad.id, Ad.title, Ad.slug)
+        if recompute:
+            query = query.filter(Ad.id > last_id).order_by(Ad.id)
+        else:
+            query = query.filter(Ad.slug.is_(None))
+        rows = query.limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        changes = [{'id': row.id, 'slug': create_slug(row.title)} for row in rows]
+        changes = [change for change, row in zip(changes, rows) if change['slug'] != row.slug]
+        if changes:
+            db.session.execute(update(Ad), changes)
+        db.session.commit()
+        updated += len(changes)
+    return {'updated': updated}
+
+
+def backfill_image_meta(batch_size=SWEEP_BATCH_SIZE, recompute=False):
+    """Store dimensions and placeholders of ad images uploaded before Ad.image_meta,
+    or too large for create_ad to decode.
+
+    Each file is read once however many ads share it; updated_at is kept,
+    so cached ad cards pick the placeholders up as they expire.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    described = {}
+    updated = 0
+    last_id = ''
+    while True:
+        rows = (db.session.query(Ad.id, Ad.images, Ad.image_meta, Ad.updated_at)
+                .filter(Ad.id > last_id).order_by(Ad.id).limit(batch_size).all())
+        if not rows:
+            break
+        last_id = rows[-1].id
+        changes = []
+        for row in rows:
+            meta = {} if recompute else dict(row.image_meta or {})
+            for image in row.images or []:
+                if 'placeholder' in meta.get(image, {}):
+                    continue
+                if image not in described:
+                    path = os.path.join(upload_folder, image)
+                    described[image] = describe_image(path) if os.path.isfile(path) else None
+                if described[image] is not None:
+                    meta[image] = described[image]
+            if meta != (row.image_meta or {}):
+                changes.append({'id': row.id, 'image_meta': meta, 'updated_at': row.updated_at})
+        if changes:
+            db.session.execute(update(Ad), changes)
+        db.session.commit()
+        updated += len(changes)
+    return {'updated': updated}
+
+
+def migrate_integer_keys(batch_size=SWEEP_BATCH_SIZE):
+    """Online migration to the integer `seq` keys, safe to rerun.
+
+    Adds the columns and indexes, assigns `seq` to rows that lack one
+    (lookup tables first), then fills the integer foreign key copies on
+    `ad` with one correlated UPDATE per batch. Tables are walked by primary
+    key since `seq` has no index. New rows get their keys from keys.py
+    while this runs, so the site can stay up: listings keep filtering on
+    the string keys until the last step stores the MIGRATED_SETTING marker
+    (see keys.integer_keys_enabled).
+    """
+    upgrade_schema()
+    result = {}
+    for model in (Country, State, City, Category, User, Ad):
+        assigned = 0
+        last_id = ''
+        while True:
+            rows = (db.session.query(model.id, model.seq).filter(model.id > last_id)
+                    .order_by(model.id).limit(batch_size).all())
+            if not rows:
+                break
+            last_id = rows[-1].id
+            ids = [row.id for row in rows if row.seq is None]
+            if not ids:
+                continue
+            connection = db.session.connection()
+            db.session.execute(update(model), [
+                {'id': row_id, 'seq': key_allocator.next_value(connection, model)} for row_id in ids
+            ])
+            db.session.commit()
+            assigned += len(ids)
+        result[model.__tablename__] = assigned
+
+    linked = 0
+    last_id = ''
+    values = {
+        seq_name: select(model.seq).where(model.id == getattr(Ad, fk_name)).scalar_subquery()
+        for fk_name, (seq_name, model) in AD_SEQ_FOREIGN_KEYS.items()
+    }
+    while True:
+        ids = [row.id for row in db.session.query(Ad.id).filter(Ad.id > last_id).order_by(Ad.id).limit(batch_size)]
+        if not ids:
+            break
+        last_id = ids[-1]
+        linked += Ad.query.filter(Ad.id.in_(ids)).update(values, synchronize_session=False)
+        db.session.commit()
+    # Ads created before their category or location had a seq, behind the walk's position
+    unlinked = or_(*[and_(getattr(Ad, seq_name).is_(None), getattr(Ad, fk_name).isnot(None))
+                     for fk_name, (seq_name, _) in AD_SEQ_FOREIGN_KEYS.items()])
+    linked += Ad.query.filter(unlinked).update(values, synchronize_session=False)
+    if not SiteSetting.query.filter_by(key=MIGRATED_SETTING).first():
+        db.session.add(SiteSetting(key=MIGRATED_SETTING, value=datetime.utcnow().isoformat(timespec='seconds'),
+                                   description='Listings filter on the integer keys (set by flask migrate-keys)'))
+    db.session.commit()
+    result['ad_links'] = linked
+    return result
+
+
+def recompute_vip_flags(user_ids, now=None):
+    """Set User.is_vip from the user's active subscriptions in one UPDATE.
+
+    Admin accounts keep their flag since they are VIP without a subscription.
+    """
+    now = now or datetime.utcnow()
+    has_active_subscription = db.session.query(VIPSubscription.id).filter(
+        VIPSubscription.user_id == User.id,
+        VIPSubscription.is_active == True,
+        VIPSubscription.end_date > now
+    ).exists()
+    return User.query.filter(
+        User.id.in_(user_ids),
+        User.is_admin == False
+    ).update({User.is_vip: has_active_subscription}, synchronize_session=False)
+
+
+def expire_vip_subscriptions(batch_size=SWEEP_BATCH_SIZE, now=None):
+    """Deactivate subscriptions past their end_date, one batch per commit.
+
+    Walks ix_vip_subscription_active_end_date so each batch only touches
+    active rows that have expired, then recomputes the VIP flag of the
+    affected users.
+    """
+    now = now or datetime.utcnow()
+    expired = users_updated = 0
+    while True:
+        rows = db.session.query(VIPSubscription.id, VIPSubscription.user_id).filter(
+            VIPSubscription.is_active == True,
+            VIPSubscription.end_date <= now
+        ).limit(batch_size).all()
+        if not rows:
+            break
+
+        subscription_ids = [row.id for row in rows]
+        user_ids = {row.user_id for row in rows}
+        expired += VIPSubscription.query.filter(
+            VIPSubscription.id.in_(subscription_ids)
+        ).update({'is_active': False, 'updated_at': now}, synchronize_session=False)
+        users_updated += recompute_vip_flags(user_ids, now)
+        db.session.commit()
+
+    if expired:
+        logger.info('Expired %d VIP subscriptions, updated %d users', expired, users_updated)
+    return {'expired': expired, 'users_updated': users_updated}
+
+
+def vip_ad_ttls(now=None, user_id=None):
+    """Map user_id -> longest ad TTL granted by the user's active VIP packages (one user's when given)"""
+    now = now or datetime.utcnow()
+    query = db.session.query(VIPSubscription.user_id, db.func.max(VIPPackage.ad_ttl_days)).join(
+        VIPPackage, VIPSubscription.package_id == VIPPackage.id
+    ).filter(
+        VIPSubscription.is_active == True,
+        VIPSubscription.end_date > now,
+        VIPPackage.ad_ttl_days.isnot(None)
+    )
+    if user_id is not None:
+        query = query.filter(VIPSubscription.user_id == user_id)
+    return dict(query.group_by(VIPSubscription.user_id).all())
+
+
+def ad_ttl_days(category_id, user_id):
+    """TTL for a new ad: VIP package first, then category, then AD_TTL_DAYS"""
+    vip_ttl = vip_ad_ttls(user_id=user_id).get(user_id) if user_id else None
+    if vip_ttl:
+        return vip_ttl
+    category = db.session.get(Category, category_id)
+    if category and category.ad_ttl_days:
+        return category.ad_ttl_days
+    return current_app.config['AD_TTL_DAYS']
+
+
+def ad_expiry_date(category_id, user_id, created_at=None):
+    """Expiry timestamp for an ad created at `created_at`"""
+    return (created_at or datetime.utcnow()) + timedelta(days=ad_ttl_days(category_id, user_id))
+
+
+def expire_ads(batch_size=SWEEP_BATCH_SIZE, now=None):
+    """Deactivate ads past their expires_at, one batch per commit.
+
+    Ads posted before TTLs existed get their expires_at backfilled first
+    from their creation date.
+    """
+    now = now or datetime.utcnow()
+    default_ttl = current_app.config['AD_TTL_DAYS']
+    category_ttls = dict(db.session.query(Category.id, Category.ad_ttl_days).filter(
+        Category.ad_ttl_days.isnot(None)))
+    user_ttls = vip_ad_ttls(now)
+
+    backfilled = 0
+    while True:
+        rows = db.session.query(Ad.id, Ad.created_at, Ad.category_id, Ad.user_id).filter(
+            Ad.expires_at.is_(None)
+        ).limit(batch_size).all()
+        if not rows:
+            break
+        db.session.execute(update(Ad), [{
+            'id': row.id,
+            'expires_at': (row.created_at or now) + timedelta(
+                days=user_ttls.get(row.user_id) or category_ttls.get(row.category_id) or default_ttl)
+        } for row in rows])
+        db.session.commit()
+        backfilled += len(rows)
+
+    expired = 0
+    while True:
+        ad_ids = [row.id for row in db.session.query(Ad.id).filter(
+            Ad.is_active == True,
+            Ad.expires_at <= now
+        ).limit(batch_size)]
+        if not ad_ids:
+            break
+        expired += Ad.query.filter(Ad.id.in_(ad_ids)).update(
+            {'is_active': False, 'updated_at': now}, synchronize_session=False)
+        db.session.commit()
+
+    if expired:
+        logger.info('Expired %d ads', expired)
+    return {'backfilled': backfilled, 'expired': expired}
+
+
+def archive_ads(batch_size=SWEEP_BATCH_SIZE, older_than_days=None, now=None):
+    """Move inactive ads untouched for `older_than_days` into ad_archive.
+
+    Each chunk is copied with one INSERT ... SELECT and removed with one
+    DELETE in the same transaction, so an ad is never in both tables.
+    """
+    now = now or datetime.utcnow()
+    if older_than_days is None:
+        older_than_days = current_app.config['AD_ARCHIVE_AFTER_DAYS']
+    cutoff = now - timedelta(days=older_than_days)
+    columns = [column.name for column in Ad.__table__.columns if column.name in AdArchive.__table__.c]
+
+    archived = 0
+    while True:
+        ad_ids = [row.id for row in db.session.query(Ad.id).filter(
+            Ad.is_active == False,
+            Ad.updated_at < cutoff
+        ).limit(batch_size)]
+        if not ad_ids:
+            break
+        db.session.execute(insert(AdArchive).from_select(
+            columns + ['archived_at'],
+            select(*[Ad.__table__.c[name] for name in columns], db.literal(now)).where(Ad.id.in_(ad_ids))
+        ))
+        archived += Ad.query.filter(Ad.id.in_(ad_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    if archived:
+        logger.info('Archived %d ads', archived)
+    return {'archived': archived}
+
+
+def sweep_ads():
+    """Scheduler job: expire ads, then archive old inactive ones"""
+    expire_ads()
+    archive_ads()
+
+
+def run_job(app, job):
+    """Run one job inside an app context, logging and discarding failures"""
+    with app.app_context():
+        try:
+            job()
+        except Exception:
+            db.session.rollback()
+            logger.exception('Maintenance job %s failed', job.__name__)
+        finally:
+            db.session.remove()
+
+
+def scheduled_jobs(app):
+    """{job: interval_seconds} of the local scheduler, without disabled jobs"""
+    jobs = {
+        expire_vip_subscriptions: app.config['VIP_SWEEP_INTERVAL'],
+        sweep_ads: app.config['AD_SWEEP_INTERVAL'],
+    }
+    return {job: interval for job, interval in jobs.items() if interval}
+
+
+def run_scheduler(app, jobs):
+    """Run `jobs` ({callable: interval_seconds}) forever in this thread"""
+    next_run = {job: time.monotonic() for job in jobs}
+    while True:
+        now = time.monotonic()
+        for job, interval in jobs.items():
+            if now >= next_run[job]:
+                run_job(app, job)
+                next_run[job] = time.monotonic() + interval
+        time.sleep(max(0.0, min(next_run.values()) - time.monotonic()))
+
+
+def start_scheduler(app, jobs):
+    """Run `jobs` in a daemon thread (single-process servers; gunicorn runs them in their own process)"""
+    if not jobs:
+        return None
+    thread = threading.Thread(target=run_scheduler, args=(app, jobs), name='maintenance-scheduler', daemon=True)
+    thread.start()
+    return thread
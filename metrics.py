@@ -0,0 +1,115 @@
+"""Prometheus metrics exposed at /metrics.
+
+Request latency, response size and DB time are recorded per endpoint in
+after_request, together with upload bytes, cache lookups, background
+queue depths and dropped log records. When PROMETHEUS_MULTIPROC_DIR is set (gunicorn), every
+worker writes its samples to files in that directory and /metrics
+aggregates all of them; otherwise the single process registry is used.
+The directory must be emptied before the server starts.
+"""
+import os
+import time
+
+from flask import Response, abort, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUEST_LATENCY = Histogram(
+    'adsvairl_request_duration_seconds', 'Request latency', ['endpoint', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+RESPONSE_SIZE = Histogram(
+    'adsvairl_response_size_bytes', 'Response body size', ['endpoint'],
+    buckets=(512, 2048, 8192, 32768, 131072, 524288, 2097152),
+)
+REQUEST_DB_TIME = Histogram(
+    'adsvairl_request_db_seconds', 'Database time spent per request', ['endpoint'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+REQUEST_QUERIES = Histogram(
+    'adsvairl_request_queries', 'SQL statements per request', ['endpoint'],
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+REQUESTS = Counter('adsvairl_requests_total', 'Requests handled', ['endpoint', 'status'])
+UPLOAD_BYTES = Counter('adsvairl_upload_bytes_total', 'Bytes received in multipart uploads', ['endpoint'])
+CACHE_LOOKUPS = Counter('adsvairl_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+DB_LOCK_WAIT = Histogram(
+    'adsvairl_db_writer_lock_wait_seconds', 'Time spent waiting for the SQLite writer lock',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+DB_LOCK_RETRIES = Counter('adsvairl_db_lock_retries_total', 'Writes retried after "database is locked"', ['function'])
+LOG_RECORDS_DROPPED = Counter('adsvairl_log_records_dropped_total', 'Log records dropped because the log queue was full')
+QUEUE_DEPTH = Gauge(
+    'adsvairl_background_queue_depth', 'Items waiting in background queues', ['queue'],
+    multiprocess_mode='livesum',
+)
+
+# name -> callable returning the current depth, sampled after each request
+_queues = {}
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def record_log_drop():
+    LOG_RECORDS_DROPPED.inc()
+
+
+def track_queue(name, depth):
+    """Report `depth()` (e.g. a Queue's qsize) as a background queue depth"""
+    _queues[name] = depth
+
+
+def mark_worker_dead(pid):
+    """Drop a dead gunicorn worker's live gauges (call from child_exit)"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+
+def metrics_registry():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def init_metrics(app):
+    """Record request metrics and serve them at /metrics"""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    allowed_ips = {ip.strip() for ip in app.config.get('METRICS_ALLOWED_IPS', '').split(',') if ip.strip()}
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get('metrics_started')
+        if started is None or request.endpoint == 'metrics':
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(endpoint, str(response.status_code)).inc()
+        if response.content_length is not None:
+            RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+        stats = g.get('request_stats')
+        if stats is not None:
+            REQUEST_DB_TIME.labels(endpoint).observe(stats.db_time)
+            REQUEST_QUERIES.labels(endpoint).observe(stats.query_count)
+        if request.mimetype == 'multipart/form-data' and request.content_length:
+            UPLOAD_BYTES.labels(endpoint).inc(request.content_length)
+        for name, depth in _queues.items():
+            QUEUE_DEPTH.labels(name).set(depth())
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if allowed_ips and request.remote_addr not in allowed_ips:
+            abort(404)
+        return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
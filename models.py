@@ -1,13 +1,36 @@
 from datetime import datetime
+import re
 import uuid
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Helper function to create URL slug from Arabic text
+def create_slug(text):
+    """Convert Arabic text to URL-friendly slug"""
+    # Remove HTML tags if any
+    text = re.sub('<.*?>', '', text)
+    
+    # Replace Arabic spaces and punctuation
+    text = re.sub(r'[^\w\s-]', '', text)
+    text = re.sub(r'[-\s]+', '-', text)
+    
+    # Remove leading/trailing hyphens
+    text = text.strip('-')
+    
+    # Limit length
+    if len(text) > 50:
+        text = text[:50].rstrip('-')
+    
+    return text.lower() if text else 'ad'
 
 class User(db.Model, UserMixin):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    seq = db.Column(db.BigInteger)  # Compact internal key, assigned by keys.py (never looked up, so not indexed)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
@@ -80,11 +103,14 @@ class PaymentMethod(db.Model):
 
 class Ad(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    seq = db.Column(db.BigInteger)  # Compact internal key, assigned by keys.py (never looked up, so not indexed)
     title = db.Column(db.String(100), nullable=False)
+    slug = db.Column(db.String(50), index=True)  # Kept in sync with title by update_slug
     description = db.Column(db.Text, nullable=False)
     price = db.Column(db.Numeric(10, 2), nullable=False)
     currency = db.Column(db.String(3), default='SAR')
     images = db.Column(db.JSON, default=list)
+    image_meta = db.Column(db.JSON, default=dict)  # {image: {width, height, placeholder}}, see images.describe_image
     
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.String(36), db.ForeignKey('category.id'), nullable=False)
@@ -92,6 +118,13 @@ class Ad(db.Model):
     state_id = db.Column(db.String(36), db.ForeignKey('state.id'))
     city_id = db.Column(db.String(36), db.ForeignKey('city.id'))
     store_id = db.Column(db.String(36), db.ForeignKey('merchant_store.id'))
+
+    # Integer copies of the foreign keys above, pointing at the referenced rows' seq
+    user_seq = db.Column(db.BigInteger)
+    category_seq = db.Column(db.BigInteger)
+    country_seq = db.Column(db.BigInteger)
+    state_seq = db.Column(db.BigInteger)
+    city_seq = db.Column(db.BigInteger)
     
     contact_phone = db.Column(db.String(20))  # Making phone optional
     contact_email = db.Column(db.String(120))
@@ -101,6 +134,7 @@ class Ad(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     
     views_count = db.Column(db.Integer, default=0)
+    expires_at = db.Column(db.DateTime, index=True)  # Deactivated by the expiry job after this
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -110,8 +144,60 @@ class Ad(db.Model):
     state = db.relationship('State', backref='ads')
     city = db.relationship('City', backref='ads')
 
+    __table_args__ = (
+        db.Index('ix_ad_category_seq_listing', 'category_seq', 'is_approved', 'is_active', 'created_at'),
+        db.Index('ix_ad_city_seq', 'city_seq'),
+    )
+
+    @validates('title')
+    def update_slug(self, key, title):
+        self.slug = create_slug(title or '')
+        return title
+
+class AdArchive(db.Model):
+    """Cold storage for old inactive ads moved out of the hot `ad` table.
+
+    Mirrors the Ad columns without foreign keys so archived rows survive
+    deletion of their category, location or owner.
+    """
+    __tablename__ = 'ad_archive'
+
+    id = db.Column(db.String(36), primary_key=True)
+    seq = db.Column(db.BigInteger)
+    title = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    price = db.Column(db.Numeric(10, 2), nullable=False)
+    currency = db.Column(db.String(3))
+    images = db.Column(db.JSON)
+
+    user_id = db.Column(db.String(36))
+    category_id = db.Column(db.String(36))
+    country_id = db.Column(db.String(36))
+    state_id = db.Column(db.String(36))
+    city_id = db.Column(db.String(36))
+    store_id = db.Column(db.String(36))
+    user_seq = db.Column(db.BigInteger)
+    category_seq = db.Column(db.BigInteger)
+    country_seq = db.Column(db.BigInteger)
+    state_seq = db.Column(db.BigInteger)
+    city_seq = db.Column(db.BigInteger)
+
+    contact_phone = db.Column(db.String(20))
+    contact_email = db.Column(db.String(120))
+
+    is_featured = db.Column(db.Boolean)
+    is_approved = db.Column(db.Boolean)
+    is_active = db.Column(db.Boolean)
+
+    views_count = db.Column(db.Integer)
+    expires_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Category(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    seq = db.Column(db.BigInteger)  # Compact internal key, assigned by keys.py (never looked up, so not indexed)
     name = db.Column(db.String(100), nullable=False)
     name_en = db.Column(db.String(100))
     description = db.Column(db.Text)
@@ -120,6 +206,7 @@ class Category(db.Model):
     icon = db.Column(db.String(50))
     color = db.Column(db.String(7))
     display_order = db.Column(db.Integer, default=0)
+    ad_ttl_days = db.Column(db.Integer)  # Ad lifetime for this category, None uses AD_TTL_DAYS
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -129,6 +216,7 @@ class Category(db.Model):
 
 class Country(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    seq = db.Column(db.BigInteger)  # Compact internal key, assigned by keys.py (never looked up, so not indexed)
     name = db.Column(db.String(100), nullable=False)
     name_en = db.Column(db.String(100))
     code = db.Column(db.String(2), unique=True)
@@ -144,6 +232,7 @@ class Country(db.Model):
 
 class State(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    seq = db.Column(db.BigInteger)  # Compact internal key, assigned by keys.py (never looked up, so not indexed)
     name = db.Column(db.String(100), nullable=False)
     name_en = db.Column(db.String(100))
     country_id = db.Column(db.String(36), db.ForeignKey('country.id'), nullable=False)
@@ -156,6 +245,7 @@ class State(db.Model):
 
 class City(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    seq = db.Column(db.BigInteger)  # Compact internal key, assigned by keys.py (never looked up, so not indexed)
     name = db.Column(db.String(100), nullable=False)
     name_en = db.Column(db.String(100))
     state_id = db.Column(db.String(36), db.ForeignKey('state.id'), nullable=False)
@@ -183,6 +273,7 @@ class VIPPackage(db.Model):
     priority_support = db.Column(db.Boolean, default=False)
     advanced_analytics = db.Column(db.Boolean, default=False)
     boost_in_search = db.Column(db.Boolean, default=False)
+    ad_ttl_days = db.Column(db.Integer)  # Ad lifetime for subscribers, overrides the category TTL
     features = db.Column(db.JSON, default=list)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -203,12 +294,20 @@ class VIPSubscription(db.Model):
     payment_method = db.Column(db.String(50))
     payment_details = db.Column(db.JSON)
     is_active = db.Column(db.Boolean, default=True)
+    processed_at = db.Column(db.DateTime)
+    processed_by = db.Column(db.String(36), db.ForeignKey('user.id'))
+    admin_notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    user = db.relationship('User', backref='subscriptions')
+    user = db.relationship('User', backref='subscriptions', foreign_keys=[user_id])
     package = db.relationship('VIPPackage', backref='subscriptions')
 
+    # Used by the expiry sweeper to find active subscriptions past end_date
+    __table_args__ = (
+        db.Index('ix_vip_subscription_active_end_date', 'is_active', 'end_date'),
+    )
+
 class AdSense(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     name = db.Column(db.String(100), nullable=False)
@@ -222,6 +321,11 @@ class AdSense(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class KeyAllocation(db.Model):
+    """High-water mark of the integer `seq` keys handed out per table"""
+    name = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.BigInteger, nullable=False)
+
 # Category model moved to top of file
 
 # Country model moved to top of file
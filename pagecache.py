@@ -0,0 +1,193 @@
+"""Full-page response cache for anonymous visitors.
+
+Views decorated with `cache_page(ttl, tags)` store their 200 responses in
+the shared cache (cache.py), keyed by path, normalized query string and
+the splash flag, and serve them to anonymous visitors without running
+the view. A response stays fresh for `ttl` seconds (PAGE_CACHE_TTLS
+overrides it per endpoint, e.g. "home=30,search=0") and is then served
+stale for up to PAGE_CACHE_STALE_SECONDS while one background thread
+re-renders it. Commits that touch the models behind `tags` drop the
+pages at once.
+
+Visitors with anything else in their session (logged in, flashed
+messages, a recent write pinned to the primary) always get a fresh
+render. Cacheable responses are marked `public` with max-age and
+stale-while-revalidate for an upstream proxy, all of them `Vary: Cookie`,
+and `X-Cache` reports HIT, STALE or MISS.
+"""
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, request, session
+
+from cache import MISSING, cache
+from compression import ENCODINGS, STORED_LEVELS, accepted_encoding, compressed_variants
+
+logger = logging.getLogger('adsvairl.pagecache')
+
+# Session keys that don't change how a public page renders (Flask-Login marks
+# every anonymous session with _fresh=False)
+PUBLIC_SESSION_KEYS = {'seen_splash', 'csrf_token', '_fresh'}
+# Query parameters that never change a page (campaign tracking)
+IGNORED_PARAMS = {'fbclid', 'gclid'}
+
+_refresher = {'pid': None, 'executor': None}
+
+
+def parse_ttls(value):
+    """"home=30,search=0" -> {'home': 30, 'search': 0}"""
+    ttls = {}
+    for item in value.split(','):
+        if '=' in item:
+            endpoint, ttl = item.split('=', 1)
+            ttls[endpoint.strip()] = int(ttl)
+    return ttls
+
+
+def normalized_query(args):
+    """Sorted query string without blank values and tracking parameters"""
+    items = sorted(
+        (key, value) for key, values in args.lists() for value in values
+        if value.strip() and key not in IGNORED_PARAMS and not key.startswith('utm_')
+    )
+    return urlencode(items)
+
+
+def is_anonymous():
+    return set(session.keys()) <= PUBLIC_SESSION_KEYS
+
+
+def page_key(path, query, seen_splash):
+    digest = hashlib.sha1(f'{path}?{query}|{int(bool(seen_splash))}'.encode()).hexdigest()
+    return f'page:{digest}'
+
+
+def refresher():
+    """Background executor of this process (threads don't survive a fork)"""
+    if _refresher['pid'] != os.getpid():
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='page-refresh')
+        _refresher.update(pid=os.getpid(), executor=executor)
+    return _refresher['executor']
+
+
+def session_state():
+    return {key: value for key, value in session.items() if key != '_fresh'}
+
+
+def render_entry(view, kwargs, ttl):
+    """Run the view; returns (response, entry) where entry is None if it can't be shared"""
+    before = session_state()
+    response = current_app.make_response(view(**kwargs))
+    # A view that changes the session (e.g. the splash screen) must run for every visitor
+    if (response.status_code != 200 or response.direct_passthrough or session_state() != before
+            or len(response.get_data()) > current_app.config.get('PAGE_CACHE_MAX_BYTES', 1024 * 1024)):
+        return response, None
+    body = response.get_data()
+    entry = {
+        'body': body,
+        # Compressed once here instead of on every hit
+        'encoded': compressed_variants(body, STORED_LEVELS, current_app.config.get('COMPRESS_MIN_BYTES', 1024))
+                   if current_app.config.get('COMPRESS_ENABLED', True) else {},
+        'mimetype': response.mimetype,
+        'headers': [(name, value) for name, value in response.headers
+                    if name.lower() not in ('content-length', 'content-type', 'set-cookie')],
+        'fresh_until': time.time() + ttl,
+    }
+    return response, entry
+
+
+def entry_response(app, entry):
+    encoded = entry.get('encoded', {})
+    encoding = accepted_encoding([encoding for encoding in ENCODINGS if encoding in encoded]) if encoded else None
+    response = app.response_class(encoded[encoding] if encoding else entry['body'], mimetype=entry['mimetype'],
+                                  headers=entry['headers'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if encoded:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def refresh(app, view, kwargs, path, query, seen_splash, key, ttl, stale, tags):
+    try:
+        with app.test_request_context(path, query_string=query):
+            if seen_splash:
+                session['seen_splash'] = True
+            _, entry = render_entry(view, kwargs, ttl)
+            if entry is not None:
+                cache.set(key, entry, ttl + stale, tags)
+    except Exception:
+        logger.exception('Refreshing cached page %s?%s failed', path, query)
+    finally:
+        cache.delete(f'refresh:{key}')
+
+
+def add_cache_headers(response, ttl, stale, status):
+    response.vary.add('Cookie')
+    if status is None:
+        response.cache_control.private = True
+        return response
+    response.cache_control.public = True
+    response.cache_control.max_age = ttl
+    response.cache_control.stale_while_revalidate = stale
+    response.headers['X-Cache'] = status
+    return response
+
+
+def cache_page(ttl, tags=(), on_hit=None):
+    """Serve this view from the page cache to anonymous visitors.
+
+    `tags` name the models the page shows (see cache.MODEL_TAGS);
+    `on_hit(**view_args)` runs when the view is skipped, e.g. to count a view.
+    """
+    tags = tuple(tags)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(**kwargs):
+            app = current_app._get_current_object()
+            page_ttl = app.config.get('PAGE_CACHE_TTLS', {}).get(request.endpoint, ttl)
+            if not app.config.get('PAGE_CACHE_ENABLED', True) or page_ttl <= 0 or not is_anonymous():
+                return add_cache_headers(app.make_response(f(**kwargs)), page_ttl, 0, None)
+
+            stale = app.config.get('PAGE_CACHE_STALE_SECONDS', 300)
+            seen_splash = session.get('seen_splash', False)
+            query = normalized_query(request.args)
+            key = page_key(request.path, query, seen_splash)
+            entry = cache.get(key, MISSING)
+            if entry is not MISSING:
+                status = 'HIT'
+                if entry['fresh_until'] < time.time():
+                    status = 'STALE'
+                    if cache.add(f'refresh:{key}', True, 60):
+                        refresher().submit(refresh, app, f, kwargs, request.path, query, seen_splash,
+                                           key, page_ttl, stale, tags)
+                if on_hit is not None:
+                    on_hit(**kwargs)
+                return add_cache_headers(entry_response(app, entry), page_ttl, stale, status)
+
+            response, entry = render_entry(f, kwargs, page_ttl)
+            if entry is None:
+                return add_cache_headers(response, page_ttl, 0, None)
+            cache.set(key, entry, page_ttl + stale, tags)
+            return add_cache_headers(entry_response(app, entry), page_ttl, stale, 'MISS')
+        return decorated_function
+    return decorator
+
+
+def init_page_cache(app):
+    """Keep responses that will set a cookie out of shared proxy caches"""
+
+    @app.after_request
+    def privatize_cookie_responses(response):
+        # The session cookie is written after this hook, whenever the session was modified
+        if response.cache_control.public and (session.modified or 'Set-Cookie' in response.headers):
+            response.cache_control.public = False
+            response.cache_control.private = True
+            response.cache_control.stale_while_revalidate = None
+        return response
@@ -0,0 +1,211 @@
+"""On-demand sampling profiler for live requests.
+
+An admin turns profiling on from /admin/profiling with a sample rate and
+an optional list of endpoints. The switch is a small JSON file under
+PROFILE_DIR so every gunicorn worker sees it; workers re-read it at most
+once a second, so a disabled profiler costs one time check per request.
+
+A sampled request gets a thread that snapshots the request thread's stack
+every PROFILE_INTERVAL_MS. When the request ends its stacks are written in
+collapsed format ("frame;frame;frame count", what flamegraph.pl and
+speedscope read) together with its SQL log, and only the
+PROFILES_PER_ENDPOINT slowest profiles of each endpoint are kept.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request
+from werkzeug.utils import secure_filename
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Samples one thread's stack from a helper thread until stopped"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+
+class ProfileStore:
+    """Profiling switch and saved profiles, kept on disk for all workers"""
+
+    def __init__(self, directory, keep_per_endpoint=5):
+        self.directory = directory
+        self.keep_per_endpoint = keep_per_endpoint
+        self._settings = None
+        self._checked_at = 0.0
+
+    @property
+    def switch_path(self):
+        return os.path.join(self.directory, 'switch.json')
+
+    def settings(self):
+        """Current switch ({'sample_rate': ..., 'endpoints': [...]}) or None when off"""
+        now = time.monotonic()
+        if now - self._checked_at >= 1.0:
+            self._checked_at = now
+            try:
+                with open(self.switch_path) as f:
+                    self._settings = json.load(f)
+            except (OSError, ValueError):
+                self._settings = None
+        return self._settings
+
+    def enable(self, sample_rate, endpoints):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.switch_path, 'w') as f:
+            json.dump({'sample_rate': sample_rate, 'endpoints': endpoints}, f)
+        self._checked_at = 0.0
+
+    def disable(self):
+        if os.path.exists(self.switch_path):
+            os.remove(self.switch_path)
+        self._checked_at = 0.0
+
+    def _endpoint_dir(self, endpoint):
+        return os.path.join(self.directory, secure_filename(endpoint))
+
+    def save(self, profile):
+        directory = self._endpoint_dir(profile['endpoint'])
+        os.makedirs(directory, exist_ok=True)
+        name = f"{int(time.time() * 1000)}-{os.getpid()}"
+        with open(os.path.join(directory, f'{name}.json'), 'w') as f:
+            json.dump(profile, f)
+        self._prune(directory)
+
+    def _prune(self, directory):
+        profiles = []
+        for filename in os.listdir(directory):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    profiles.append((json.load(f)['duration'], filename))
+            except (OSError, ValueError, KeyError):
+                continue  # Being written by another worker
+        profiles.sort(reverse=True)
+        for _, filename in profiles[self.keep_per_endpoint:]:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass
+
+    def load(self, endpoint, name):
+        path = os.path.join(self._endpoint_dir(endpoint), f'{secure_filename(name)}.json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def summaries(self):
+        """{endpoint: [profile without stacks/queries, slowest first]}"""
+        result = {}
+        if not os.path.isdir(self.directory):
+            return result
+        for endpoint in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, endpoint)
+            if not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        profile = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                result.setdefault(endpoint, []).append({
+                    'name': filename[:-len('.json')], 'url': profile['url'], 'duration': profile['duration'],
+                    'query_count': len(profile['queries']), 'samples': sum(profile['stacks'].values()),
+                    'created_at': profile['created_at'],
+                })
+        for profiles in result.values():
+            profiles.sort(key=lambda profile: profile['duration'], reverse=True)
+        return result
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for endpoint in os.listdir(self.directory):
+            directory = os.path.join(self.directory, endpoint)
+            if os.path.isdir(directory):
+                for filename in os.listdir(directory):
+                    os.remove(os.path.join(directory, filename))
+
+
+def collapsed_stacks(profile):
+    """Profile stacks in collapsed format, one 'stack count' line each"""
+    return ''.join(f'{stack} {count}\n' for stack, count in
+                   sorted(profile['stacks'].items(), key=lambda item: item[1], reverse=True))
+
+
+def init_profiling(app):
+    """Sample requests while the admin switch is on"""
+    store = ProfileStore(app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles'),
+                         app.config.get('PROFILES_PER_ENDPOINT', 5))
+    interval = app.config.get('PROFILE_INTERVAL_MS', 5) / 1000.0
+    app.extensions['profile_store'] = store
+
+    @app.before_request
+    def start_profiler():
+        settings = store.settings()
+        if settings is None or request.endpoint in (None, 'static'):
+            return
+        if settings['endpoints'] and request.endpoint not in settings['endpoints']:
+            return
+        if random.random() >= settings['sample_rate']:
+            return
+        stats = g.get('request_stats')
+        if stats is not None:
+            stats.log = []
+        g.profiler = StackSampler(threading.get_ident(), interval).start()
+        g.profiler_started = time.perf_counter()
+
+    @app.teardown_request
+    def save_profile(exc):
+        sampler = g.pop('profiler', None)
+        if sampler is None:
+            return
+        stacks = sampler.stop()
+        stats = g.get('request_stats')
+        store.save({
+            'endpoint': request.endpoint,
+            'url': request.full_path,
+            'duration': time.perf_counter() - g.profiler_started,
+            'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'stacks': dict(stacks),
+            'queries': [
+                {'at': at, 'duration': duration, 'statement': statement, 'params': params}
+                for at, duration, statement, params in (stats.log or [] if stats else [])
+            ],
+        })
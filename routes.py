@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, current_app
 from models import db, User, MerchantStore, Ad, Category, Country, VIPPackage
+from tracing import save_upload
 from werkzeug.utils import secure_filename
 import os
 from functools import wraps
@@ -173,7 +174,7 @@ def update_store_banner():
     
     if file:
         filename = secure_filename(f"store_banner_{user.store.id}_{file.filename}")
-        file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+        save_upload(file, os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
         user.store.banner_url = filename
         
         try:
@@ -199,7 +200,7 @@ def update_store_logo():
     
     if file:
         filename = secure_filename(f"store_logo_{user.store.id}_{file.filename}")
-        file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+        save_upload(file, os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
         user.store.logo_url = filename
         
         try:
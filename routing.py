@@ -0,0 +1,86 @@
+"""Read-replica routing for the Flask-SQLAlchemy session.
+
+Views decorated with `read_replica` send their SELECTs to one of the
+engines configured through DATABASE_REPLICA_URLS, while writes and
+everything else stay on the primary. A client that has just written
+(any non-GET request that changed the database, e.g. create_ad) is
+pinned to the primary for REPLICA_STICKY_SECONDS so it reads its own
+writes; the session key is dropped again once that window has passed.
+"""
+import random
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql import Select
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for a comma separated list of replica URLs"""
+    return {
+        f'{REPLICA_BIND_PREFIX}{index}': url.strip()
+        for index, url in enumerate(urls.split(',')) if url.strip()
+    }
+
+
+def read_replica(f):
+    """Allow this view's read queries to go to a replica"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.use_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def should_use_replica():
+    if not has_request_context() or not g.get('use_replica') or g.get('db_wrote'):
+        return False
+    last_write_at = flask_session.get('last_write_at')
+    return not last_write_at or time.time() - last_write_at > current_app.config['REPLICA_STICKY_SECONDS']
+
+
+class RoutingSession(Session):
+    """Session that sends SELECTs from `read_replica` views to a replica engine"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and isinstance(clause, Select) and should_use_replica():
+            replicas = [engine for key, engine in self._db.engines.items()
+                        if key and key.startswith(REPLICA_BIND_PREFIX)]
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def mark_flush_write(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def mark_dml_write(orm_execute_state):
+    if has_request_context() and not orm_execute_state.is_select:
+        g.db_wrote = True
+
+
+def init_replica_routing(app):
+    """Remember recent writers so their next reads hit the primary"""
+    if not any(key.startswith(REPLICA_BIND_PREFIX) for key in app.config.get('SQLALCHEMY_BINDS', {})):
+        return
+
+    @app.before_request
+    def forget_last_write():
+        # Once the window has passed the key only keeps the page cache from treating the client as anonymous
+        last_write_at = flask_session.get('last_write_at')
+        if last_write_at and time.time() - last_write_at > app.config['REPLICA_STICKY_SECONDS']:
+            flask_session.pop('last_write_at')
+
+    @app.after_request
+    def remember_last_write(response):
+        if g.get('db_wrote') and request.method != 'GET':
+            flask_session['last_write_at'] = time.time()
+        return response
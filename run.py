@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 import os
-from app import app
+from app import create_app
+from maintenance import scheduled_jobs, start_scheduler
+from warmup import warm_up
+
+app = create_app()
 
 if __name__ == '__main__':
     # Set up environment
     os.environ.setdefault('FLASK_ENV', 'development')
     
+    if app.config['WARM_UP']:
+        warm_up(app)
+
+    # Maintenance jobs in this process only, not in the reloader's watcher
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_scheduler(app, scheduled_jobs(app))
+
     # Run the Flask app
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -1,8 +1,10 @@
-from app import app, db
+from app import create_app, db
 from models import Ad, Category, User, Country, State, City
 from datetime import datetime
 import random
 
+app = create_app()
+
 def create_sample_ads():
     with app.app_context():
         # تأكد من وجود مستخدم على الأقل
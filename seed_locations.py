@@ -1,7 +1,9 @@
-from app import app, db
+from app import create_app, db
 from models import Country, State, City
 import uuid
 
+app = create_app()
+
 def create_sample_locations():
     with app.app_context():
         # التحقق من وجود السعودية
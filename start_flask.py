@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
 import sys
-from app import app, db
+from app import create_app, db
+
+app = create_app()
 
 if __name__ == '__main__':
     # Set up environment
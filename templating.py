@@ -0,0 +1,90 @@
+"""Faster template loading for production workers.
+
+Compiled template code is kept in a Jinja bytecode cache on disk
+(TEMPLATE_CACHE_DIR, default instance/jinja_cache), keyed by each
+template's source checksum, so restarted and newly started workers skip
+parsing and code generation. `flask --app wsgi compile-templates` goes
+further and writes every template as a Python module to
+TEMPLATE_BUNDLE_DIR (default instance/compiled_templates); when that
+bundle exists it is imported instead of reading the sources at all. A
+bundle older than any template is ignored with a warning, so a forgotten
+rebuild never serves stale markup.
+
+Outside debug mode Flask already loads each template once per process
+and never checks it for changes (TEMPLATES_AUTO_RELOAD).
+"""
+import logging
+import os
+import shutil
+import time
+
+from jinja2 import ChoiceLoader, FileSystemBytecodeCache, ModuleLoader
+
+logger = logging.getLogger('adsvairl.templates')
+
+TEMPLATE_EXTENSIONS = ['html', 'txt', 'xml']
+BUILT_MARKER = '.built'
+
+
+class BundleLoader(ChoiceLoader):
+    """Precompiled modules first, the source loader for anything else"""
+
+    def __init__(self, bundle_dir, source_loader):
+        super().__init__([ModuleLoader(bundle_dir), source_loader])
+        self.source_loader = source_loader
+
+    def get_source(self, environment, template):
+        return self.source_loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.source_loader.list_templates()
+
+
+def template_dirs(app):
+    loaders = [app.jinja_loader] + [bp.jinja_loader for bp in app.iter_blueprints()]
+    return [path for loader in loaders if loader is not None for path in loader.searchpath]
+
+
+def newest_template_mtime(app):
+    newest = 0.0
+    for directory in template_dirs(app):
+        for root, _, files in os.walk(directory):
+            for name in files:
+                newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+    return newest
+
+
+def bundle_dir(app):
+    return app.config.get('TEMPLATE_BUNDLE_DIR') or os.path.join(app.instance_path, 'compiled_templates')
+
+
+def build_bundle(app):
+    """Compile every template into bundle_dir(app); returns (path, count).
+
+    Syntax errors are raised rather than skipped so a broken template
+    fails the build instead of the first request that renders it.
+    """
+    target = bundle_dir(app)
+    shutil.rmtree(target, ignore_errors=True)
+    names = app.jinja_env.list_templates(extensions=TEMPLATE_EXTENSIONS)
+    app.jinja_env.compile_templates(target, extensions=TEMPLATE_EXTENSIONS, zip=None, ignore_errors=False)
+    with open(os.path.join(target, BUILT_MARKER), 'w') as f:
+        f.write(f'{time.time()}\n')
+    return target, len(names)
+
+
+def init_templates(app):
+    """Attach the bytecode cache and, when it is up to date, the bundle"""
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    target = bundle_dir(app)
+    marker = os.path.join(target, BUILT_MARKER)
+    if not os.path.exists(marker):
+        return
+    if os.path.getmtime(marker) < newest_template_mtime(app):
+        logger.warning('Template bundle %s is older than the templates, ignoring it; '
+                       'rebuild with `flask compile-templates`', target)
+        return
+    app.jinja_env.loader = BundleLoader(target, app.jinja_env.loader)
@@ -0,0 +1,232 @@
+"""Lightweight request tracing.
+
+A sample of requests (TRACE_SAMPLE_RATE) gets a Trace on `g` with one span
+for the request, one per SQL statement, one per template render (every
+`{% include %}` and `{% extends %}` included) and one per uploaded file
+saved through `save_upload`. Finished traces go to an in-memory ring
+buffer shown on /admin/traces and, when TRACE_FILE is set, are appended
+to that JSONL file by a background thread.
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MAX_SPANS = 2000  # per trace, so a runaway loop can't eat the worker's memory
+
+
+class Trace:
+    """Spans recorded for one request, as JSON-ready dicts"""
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = datetime.utcnow()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self._stack = []
+
+    def start(self, kind, name, **attrs):
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = {
+            'id': len(self.spans),
+            'parent': self._stack[-1]['id'] if self._stack else None,
+            'kind': kind,
+            'name': name,
+            'start': time.perf_counter() - self.origin,
+            'duration': None,
+            'attrs': attrs,
+        }
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    def finish(self, span, **attrs):
+        if span is None:
+            return
+        span['duration'] = time.perf_counter() - self.origin - span['start']
+        span['attrs'].update(attrs)
+        if span in self._stack:
+            del self._stack[self._stack.index(span):]
+
+    def self_times(self):
+        """Time spent in each span kind excluding its child spans"""
+        child_time = {}
+        for span in self.spans:
+            if span['parent'] is not None and span['duration'] is not None:
+                child_time[span['parent']] = child_time.get(span['parent'], 0.0) + span['duration']
+        totals = {}
+        for span in self.spans:
+            if span['duration'] is not None:
+                own = max(0.0, span['duration'] - child_time.get(span['id'], 0.0))
+                totals[span['kind']] = totals.get(span['kind'], 0.0) + own
+        return totals
+
+    def to_dict(self):
+        root = self.spans[0] if self.spans else {}
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': root.get('duration') or 0.0,
+            'self_times': self.self_times(),
+            'dropped_spans': self.dropped,
+            'spans': self.spans,
+        }
+
+
+def current_trace():
+    if has_request_context():
+        return g.get('trace')
+    return None
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """Record the enclosed block as a span of the current trace, if any"""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    current = trace.start(kind, name, **attrs)
+    try:
+        yield current
+    finally:
+        trace.finish(current)
+
+
+def save_upload(file, path):
+    """FileStorage.save inside a 'file' span"""
+    with span('file', f'save {os.path.basename(path)}') as current:
+        file.save(path)
+        if current is not None:
+            current['attrs']['bytes'] = os.path.getsize(path)
+
+
+class TracedTemplate(Template):
+    """Template whose renders (including includes and parents) are spans"""
+
+    @classmethod
+    def _from_namespace(cls, environment, namespace, globals):
+        template = super()._from_namespace(environment, namespace, globals)
+        render = template.root_render_func
+        name = template.name
+
+        def traced_render(context):
+            trace = current_trace()
+            if trace is None:
+                yield from render(context)
+                return
+            current = trace.start('template', name)
+            try:
+                yield from render(context)
+            finally:
+                trace.finish(current)
+
+        template.root_render_func = traced_render
+        return template
+
+
+class TraceBuffer:
+    """Most recent finished traces of this process"""
+
+    def __init__(self, size=200):
+        self._lock = threading.Lock()
+        self.traces = deque(maxlen=size)
+
+    def add(self, trace):
+        with self._lock:
+            self.traces.appendleft(trace)
+
+    def all(self):
+        with self._lock:
+            return list(self.traces)
+
+    def get(self, trace_id):
+        with self._lock:
+            return next((trace for trace in self.traces if trace['trace_id'] == trace_id), None)
+
+    def clear(self):
+        with self._lock:
+            self.traces.clear()
+
+
+class JsonlExporter:
+    """Appends traces to a JSONL file from a background thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self._thread = None
+
+    def export(self, trace):
+        if self._thread is None or self._thread.ident is None or not self._thread.is_alive():
+            # First use, or first use after a fork
+            self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+            self._thread.start()
+        self.queue.put(trace)
+
+    def _run(self):
+        while True:
+            trace = self.queue.get()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(trace, ensure_ascii=False) + '\n')
+
+
+trace_buffer = TraceBuffer()
+
+
+def init_tracing(app):
+    """Trace a sample of requests into the ring buffer (and TRACE_FILE)"""
+    sample_rate = app.config.get('TRACE_SAMPLE_RATE', 0.0)
+    if not sample_rate:
+        return
+    trace_buffer.traces = deque(maxlen=app.config.get('TRACE_BUFFER_SIZE', 200))
+    exporter = JsonlExporter(app.config['TRACE_FILE']) if app.config.get('TRACE_FILE') else None
+    app.jinja_env.template_class = TracedTemplate
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_sql_span(conn, cursor, statement, parameters, context, executemany):
+        trace = current_trace()
+        if trace is not None and context is not None:
+            verb = (statement.split(None, 1) or ['SQL'])[0].upper()
+            context._trace_span = trace.start('sql', verb, statement=statement)
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def finish_sql_span(conn, cursor, statement, parameters, context, executemany):
+        current = getattr(context, '_trace_span', None)
+        trace = current_trace()
+        if current is not None and trace is not None:
+            trace.finish(current)
+
+    @app.before_request
+    def start_trace():
+        if request.endpoint == 'static' or random.random() >= sample_rate:
+            return
+        trace = Trace(g.get('request_id') or os.urandom(8).hex(), f'{request.method} {request.path}')
+        trace.start('request', request.endpoint or 'unmatched', url=request.full_path)
+        g.trace = trace
+
+    @app.teardown_request
+    def finish_trace(exc):
+        trace = g.pop('trace', None)
+        if trace is None:
+            return
+        trace.finish(trace.spans[0], error=repr(exc) if exc else None)
+        finished = trace.to_dict()
+        trace_buffer.add(finished)
+        if exporter is not None:
+            exporter.export(finished)
@@ -0,0 +1,128 @@
+"""Cache warming run before a process accepts traffic.
+
+Every template under templates/ is compiled, the seq lookup cache is
+filled, and the hot pages are requested once through the test client so
+the site settings, category, location and AdSense lookups they make have
+their SQL compiled and their rows in the database page cache. Under
+gunicorn --preload the master does this before forking (workers inherit
+the result copy-on-write) and each worker repeats the requests on its own
+connections before serving; /ready answers 503 until the current process
+has warmed up.
+"""
+import logging
+import os
+import time
+
+from flask import jsonify
+
+from database import dispose_engines
+from keys import integer_keys_enabled, prime_seq_cache
+from models import db, Country, State
+
+logger = logging.getLogger('adsvairl.warmup')
+
+
+def compile_templates(app):
+    """Load every template into the Jinja cache; returns how many"""
+    names = app.jinja_env.list_templates(extensions=['html', 'txt', 'xml'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_up_urls():
+    """Read-only pages and APIs that most visitors hit first.
+
+    Only pages whose size doesn't grow with the number of ads: category and
+    search results aren't paginated, so rendering them here could outlast
+    the worker boot timeout on a large database.
+    """
+    country = Country.query.filter_by(is_active=True).first()
+    state = State.query.filter_by(country_id=country.id).first() if country else None
+    urls = ['/', '/all-ads', '/add-ad', '/api/categories']
+    if country:
+        urls.append(f'/api/states/{country.id}')
+    if state:
+        urls.append(f'/api/cities/{state.id}')
+    return urls
+
+
+def request_hot_pages(app):
+    """GET warm_up_urls() in-process; returns the URLs that failed"""
+    with app.app_context():
+        try:
+            urls = warm_up_urls()
+        except Exception:
+            logger.exception('Could not look up warm-up URLs')
+            return ['warm_up_urls()']
+        finally:
+            db.session.remove()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['seen_splash'] = True
+    failed = []
+    for url in urls:
+        try:
+            response = client.get(url, headers={'X-Request-ID': 'warm-up'})
+            if response.status_code >= 400:
+                failed.append(f'{url} ({response.status_code})')
+        except Exception:
+            logger.exception('Warm-up request to %s failed', url)
+            failed.append(url)
+    return failed
+
+
+def warm_up(app, dispose=True):
+    """Warm this process's caches; returns the warm-up state.
+
+    Pass dispose=False in a worker to keep the connections it just warmed.
+    """
+    state = app.extensions.setdefault('warm_up', {})
+    state.update(pid=os.getpid(), ready=False)
+    started = time.perf_counter()
+    timings = {}
+
+    step = time.perf_counter()
+    templates = compile_templates(app)
+    timings['templates_ms'] = (time.perf_counter() - step) * 1000
+
+    step = time.perf_counter()
+    with app.app_context():
+        if integer_keys_enabled():
+            prime_seq_cache(db.session.connection())
+        db.session.remove()
+    timings['caches_ms'] = (time.perf_counter() - step) * 1000
+
+    step = time.perf_counter()
+    failed = request_hot_pages(app)
+    timings['requests_ms'] = (time.perf_counter() - step) * 1000
+
+    if dispose:
+        # Don't hand live connections to forked workers
+        dispose_engines(app)
+    timings['total_ms'] = (time.perf_counter() - started) * 1000
+    state.update(ready=True, templates=templates, failed=failed, timings=timings)
+    if failed:
+        logger.warning('Warm-up requests failed: %s', ', '.join(failed))
+    logger.info('Warm-up done in %.0f ms (templates %.0f ms, caches %.0f ms, requests %.0f ms)',
+                timings['total_ms'], timings['templates_ms'], timings['caches_ms'], timings['requests_ms'])
+    return state
+
+
+def is_ready(app):
+    if not app.config.get('WARM_UP', True):
+        return True
+    state = app.extensions.get('warm_up', {})
+    # A forked worker inherits the master's state but not its connections
+    return state.get('ready', False) and state.get('pid') == os.getpid()
+
+
+def init_warmup(app):
+    """Serve /ready for load balancers and deploy scripts"""
+
+    @app.route('/ready')
+    def ready():
+        state = app.extensions.get('warm_up', {})
+        body = {'ready': is_ready(app), 'pid': os.getpid(), 'timings': state.get('timings'),
+                'failed': state.get('failed', [])}
+        return jsonify(body), 200 if body['ready'] else 503
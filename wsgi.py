@@ -0,0 +1,15 @@
+"""WSGI entry point for gunicorn and the flask CLI.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    flask --app wsgi upgrade-db
+"""
+import time
+
+_started = time.perf_counter()
+from app import create_app  # noqa: E402
+
+_imported = time.perf_counter()
+app = create_app()
+app.extensions['startup']['import_ms'] = (_imported - _started) * 1000
+app.logger.info('Startup: import %.0f ms, create_app %.0f ms',
+                app.extensions['startup']['import_ms'], app.extensions['startup']['create_app_ms'])